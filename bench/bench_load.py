@@ -0,0 +1,263 @@
+"""
+End-to-end load test against local upstream stubs.
+
+Starts the Graph / Zulip / RT stand-ins from bench/stubs.py, runs the bridge
+(`python main.py`) against them with a throwaway state file, walks every
+simulated customer through the intake questions, then fires a mix of signed
+WhatsApp webhooks (text / image / document) and Zulip webhooks (text /
+attachment). Reports webhook throughput, p50/p99 acknowledge and delivery
+latency, upstream call counts and how much the state files grew.
+
+    python bench/bench_load.py [--customers 20] [--messages 25] [--concurrency 16]
+                               [--db-mode journal] [--latency-ms 20] [--error-rate 0.01]
+
+Delivery latency is measured from sending a webhook until the stub for the
+other side receives the message (each one carries a "#load-<n>" marker).
+"""
+import argparse, hashlib, hmac, json, os, random, shlex, shutil, subprocess, sys, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import stubs
+
+APP_SECRET = "bench-secret"
+PHONE_ID = "100000000000001"
+BOT_EMAIL = "bridge-bot@bench.local"
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * (len(values) - 1) + 0.5))]
+
+
+def state_bytes(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, f))
+               for root, _, files in os.walk(directory) for f in files
+               if os.path.relpath(root, directory) != "." or f.startswith("state"))
+
+
+class Driver:
+    def __init__(self, bridge_url: str, concurrency: int):
+        self.url = bridge_url
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+        self._ids = iter(range(1, 1 << 62))
+        self._lock = threading.Lock()
+        self.ack_ms = []
+        self.failures = 0
+        self.sent = {}   # marker -> perf_counter at send
+        self.outbox_pending = 0   # deliveries left to retry when wait_idle last looked
+
+    def next_id(self) -> int:
+        with self._lock:
+            return next(self._ids)
+
+    def _post(self, path: str, data: bytes, headers: dict, marker: int | None = None):
+        started = time.perf_counter()
+        if marker is not None:
+            self.sent[marker] = started
+        try:
+            ok = self.session.post(self.url + path, data=data, headers=headers, timeout=30).ok
+        except requests.RequestException:
+            ok = False
+        elapsed = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self.ack_ms.append(elapsed)
+            self.failures += not ok
+
+    def whatsapp(self, phone: str, kind: str, marker: int | None = None, text: str = ""):
+        n = self.next_id()
+        tag = f" #load-{marker}" if marker is not None else ""
+        msg = {"from": phone, "id": f"wamid.bench{n}", "timestamp": str(int(time.time())), "type": kind}
+        if kind == "text":
+            msg["text"] = {"body": (text or f"customer message {n}") + tag}
+        elif kind == "image":
+            msg["image"] = {"id": f"img{n}", "mime_type": "image/jpeg", "caption": f"screenshot {n}{tag}"}
+        else:
+            msg["document"] = {"id": f"doc{n}", "filename": f"report-{n}.pdf",
+                               "mime_type": "application/pdf", "caption": f"report {n}{tag}"}
+        body = json.dumps({"object": "whatsapp_business_account", "entry": [{"id": "bench", "changes": [{
+            "field": "messages",
+            "value": {"messaging_product": "whatsapp",
+                      "metadata": {"display_phone_number": "15550000000", "phone_number_id": PHONE_ID},
+                      "contacts": [{"wa_id": phone, "profile": {"name": "Load Test"}}],
+                      "messages": [msg]},
+        }]}]}).encode()
+        sig = "sha256=" + hmac.new(APP_SECRET.encode(), body, hashlib.sha256).hexdigest()
+        self._post("/webhook", body, {"Content-Type": "application/json", "X-Hub-Signature-256": sig}, marker)
+
+    def zulip(self, phone: str, subject: str, kind: str, marker: int | None = None):
+        n = self.next_id()
+        tag = f" #load-{marker}" if marker is not None else ""
+        content = (f"[notes-{n}.txt](/user_uploads/1/ab/notes-{n}.txt){tag}" if kind == "attachment"
+                   else f"engineer reply {n}{tag}")
+        body = json.dumps({"token": "bench", "message": {
+            "id": 10_000_000 + n, "sender_email": "engineer@bench.local", "type": "stream",
+            "display_recipient": "SupportChat-test", "subject": f"{phone} | {subject}", "content": content,
+        }}).encode()
+        self._post("/webhook/zulip", body, {"Content-Type": "application/json"}, marker)
+
+    def wait_idle(self, timeout: float, outbox: bool = True) -> bool:
+        """
+        Poll /health/queue until no webhook jobs are queued or running and,
+        with `outbox`, /health/outbox until no failed deliveries are left to retry.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                if self.session.get(self.url + "/health/queue", timeout=5).json()["depth"] == 0:
+                    if not outbox:
+                        return True
+                    self.outbox_pending = self.session.get(self.url + "/health/outbox", timeout=5).json()["pending"]
+                    if self.outbox_pending == 0:
+                        return True
+            except (requests.RequestException, ValueError, KeyError):
+                pass
+            time.sleep(0.05)
+        return False
+
+
+def start_bridge(args, upstreams: dict, state_dir: str):
+    env = dict(os.environ,
+               ZULIP_BOT_EMAIL=BOT_EMAIL, ZULIP_API_KEY="bench", ZULIP_BOT_DM_EMAIL="dm@bench.local",
+               ZULIP_EXTRA_BOT_EMAIL="extra@bench.local", GRAPH_API_TOKEN="bench", WEBHOOK_VERIFY_TOKEN="bench",
+               BUSINESS_PHONE_NUMBER_ID=PHONE_ID, META_APP_SECRET=APP_SECRET, RT_TOKEN="bench",
+               GRAPH_API_URL=upstreams["graph"][1], ZULIP_BASE_URL=upstreams["zulip"][1],
+               RT_BASE_URL=upstreams["rt"][1],
+               PORT=str(args.port), BRIDGE_DB_MODE=args.db_mode,
+               BRIDGE_DB_FILE=os.path.join(state_dir, "state.json"))
+    log = open(os.path.join(state_dir, "bridge.log"), "w")
+    cmd = shlex.split(args.bridge_cmd.format(python=shlex.quote(sys.executable), port=args.port))
+    proc = subprocess.Popen(cmd, cwd=os.path.dirname(HERE), env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{args.port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"bridge exited with {proc.returncode}, see {log.name}")
+        try:
+            if requests.get(url + "/health", timeout=1).ok:
+                return proc, url, log.name
+        except requests.RequestException:
+            time.sleep(0.1)
+    proc.kill()
+    raise SystemExit(f"bridge did not come up, see {log.name}")
+
+
+def plan(args, phones: list[str]) -> list[tuple]:
+    """
+    (sender, phone, kind) events in a random order that keeps each customer's
+    messages in sequence.
+    """
+    rng = random.Random(args.seed)
+    wa_kinds = ["text"] * 70 + ["image"] * 15 + ["document"] * 15
+    zu_kinds = ["text"] * 85 + ["attachment"] * 15
+    queues = []
+    for phone in phones:
+        q = []
+        for _ in range(args.messages):
+            if rng.random() < args.engineer_share:
+                q.append(("zulip", phone, rng.choice(zu_kinds)))
+            else:
+                q.append(("whatsapp", phone, rng.choice(wa_kinds)))
+        queues.append(q)
+    events = []
+    while queues:
+        q = rng.choice(queues)
+        events.append(q.pop(0))
+        if not q:
+            queues.remove(q)
+    return events
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--customers", type=int, default=20)
+    p.add_argument("--messages", type=int, default=25, help="messages per customer after intake")
+    p.add_argument("--engineer-share", type=float, default=0.3, help="fraction of messages sent from Zulip")
+    p.add_argument("--concurrency", type=int, default=16, help="webhooks in flight at once")
+    p.add_argument("--db-mode", default="journal", choices=("json", "journal", "shards", "sqlite"))
+    p.add_argument("--port", type=int, default=5099)
+    p.add_argument("--bridge-cmd", default="{python} main.py",
+                   help="command that starts the bridge on {port}, e.g. "
+                        "'gunicorn -w 1 --threads 8 -b 127.0.0.1:{port} main:app'")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--drain-timeout", type=float, default=120.0)
+    p.add_argument("--keep", action="store_true", help="keep the state directory and bridge log")
+    stubs.add_arguments(p)
+    args = p.parse_args()
+
+    upstreams = stubs.from_arguments(args)
+    state_dir = tempfile.mkdtemp(prefix="bridge-bench-")
+    proc, url, log_path = start_bridge(args, upstreams, state_dir)
+    driver = Driver(url, args.concurrency)
+    phones = [f"4479{i:08d}" for i in range(args.customers)]
+    subject = "load test"
+
+    try:
+        # intake: greeting, subject, description, one customer per thread
+        def intake(phone):
+            for text in ("hi", subject, "generated by bench_load.py"):
+                driver.whatsapp(phone, "text", text=text)
+                driver.wait_idle(args.drain_timeout, outbox=False)
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            list(pool.map(intake, phones))
+        driver.ack_ms.clear()
+        driver.failures = 0
+        base_calls = {n: sum(s.calls.values()) for n, (s, _) in upstreams.items()}
+        size_before = state_bytes(state_dir)
+
+        events = plan(args, phones)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            for marker, (sender, phone, kind) in enumerate(events):
+                if sender == "whatsapp":
+                    pool.submit(driver.whatsapp, phone, kind, marker)
+                else:
+                    pool.submit(driver.zulip, phone, subject, kind, marker)
+        sent_done = time.perf_counter()
+        drained = driver.wait_idle(args.drain_timeout)
+        finished = time.perf_counter()
+        size_after = state_bytes(state_dir)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(3)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        for stub, _ in upstreams.values():
+            stub.stop()
+
+    delivered = {}
+    for name in ("graph", "zulip"):
+        delivered.update(upstreams[name][0].delivered)
+    delivery_ms = [(delivered[m] - driver.sent[m]) * 1000 for m in delivered if m in driver.sent]
+
+    n = len(events)
+    print(f"bridge:       db={args.db_mode}  customers={args.customers}  "
+          f"concurrency={args.concurrency}")
+    print(f"webhooks:     {n} sent in {sent_done - started:.2f}s = {n / (sent_done - started):.1f}/s, "
+          f"{driver.failures} non-2xx")
+    print(f"ack latency:  p50 {percentile(driver.ack_ms, 0.5):.1f} ms  p99 {percentile(driver.ack_ms, 0.99):.1f} ms")
+    print(f"processed:    {n / (finished - started):.1f} msg/s end to end"
+          + ("" if drained else "  (queue or outbox did NOT drain before the timeout)"))
+    print(f"delivery:     {len(delivery_ms)}/{n} delivered  p50 {percentile(delivery_ms, 0.5):.1f} ms  "
+          f"p99 {percentile(delivery_ms, 0.99):.1f} ms  ({driver.outbox_pending} still in the outbox)")
+    for name, (stub, _) in upstreams.items():
+        calls = sum(stub.calls.values()) - base_calls[name]
+        print(f"{name + ':':13} {calls} calls  {stub.errors} injected errors  (incl. intake: "
+              + " ".join(f"{k}={v}" for k, v in sorted(stub.calls.items())) + ")")
+    print(f"state files:  {size_before} -> {size_after} bytes ({size_after - size_before:+d}, "
+          f"{(size_after - size_before) / max(n, 1):.0f} per message)")
+    if args.keep:
+        print(f"kept {state_dir} (bridge log: {log_path})")
+    else:
+        shutil.rmtree(state_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Transcript renderer benchmark.
+
+Renders synthetic transcripts of 10, 1k and 100k lines with transcript.render
+and with the string-line renderer it replaced (kept below as the reference),
+checks the HTML is identical and prints timings, plus the memory a transcript
+takes as old string lines and as a transcript.Lines column store.
+
+    python bench/bench_transcript.py [sizes...]
+"""
+import html, os, random, re, sys, time, tracemalloc
+from urllib.parse import urljoin
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import transcript
+
+ZULIP_API_URL = "https://chat-test.filmlight.ltd.uk/api/v1/messages"
+ZULIP_BASE_URL = ZULIP_API_URL.split('/api', 1)[0]
+
+SAMPLES = [
+    "Customer to ENG: the grading panel freezes after export",
+    "ENG to Customer: can you send the log from https://example.com/logs?id=42 please",
+    "Customer sent image: screenshot of the error </user_uploads/2/ab/shot.png>",
+    "Customer sent file:  </user_uploads/2/cd/bundle.zip>",
+    "ENG sent file: patch-notes.pdf (as application/pdf)",
+    "ENG to Customer: try /user_uploads/2/ef/fix.txt and restart",
+    "Customer to ENG: line one\nline two <b>&</b>",
+    "free-form note without a prefix",
+]
+
+
+def legacy_format_transcript_html(ticket_id: int, lines: list[str], first_index: int = 1) -> str:
+    """
+    Rewritten visual style:
+      - Card-based chat log instead of a table
+      - Colored role pill (Customer → Engineer / Engineer → Customer / Note)
+      - Subtle message index on the right
+      - Minimal inline styles (RT-friendly); readable even if styles are stripped
+      - URL and /user_uploads links are auto-linked
+    """
+    ZULIP_BASE_URL = ZULIP_API_URL.split('/api', 1)[0]
+
+    def linkify(s: str) -> str:
+        s = re.sub(
+            r'(https?://[^\s<]+)',
+            lambda m: f'<a href="{html.escape(m.group(0))}" target="_blank" rel="noopener">{html.escape(m.group(0))}</a>',
+            s,
+        )
+        s = re.sub(
+            r'(/user_uploads/[^\s<]+)',
+            lambda m: f'<a href="{html.escape(urljoin(ZULIP_BASE_URL, m.group(1)))}" target="_blank" rel="noopener">Download</a>',
+            s,
+        )
+        return s
+
+    cards = []
+    for i, raw in enumerate(lines, first_index):
+        direction = "Note"
+        content = raw
+        link_url = None
+        pill_bg = "#e5e7eb"  # neutral
+        pill_fg = "#111827"
+
+        m = re.match(r'^(Customer to ENG|ENG to Customer):\s*(.*)$', raw, re.I)
+        if m:
+            direction_key = m.group(1).lower()
+            if "customer to eng" in direction_key:
+                direction = "Customer → Engineer"
+                pill_bg, pill_fg = "#dbeafe", "#1e3a8a"  # blue
+            else:
+                direction = "Engineer → Customer"
+                pill_bg, pill_fg = "#dcfce7", "#14532d"  # green
+            content = m.group(2)
+
+        m2 = re.match(r'^Customer sent (?:image|file):\s*(.*?)(?:\s*<(.+?)>)?\s*$', raw, re.I)
+        if m2:
+            direction = "Customer → Engineer"
+            pill_bg, pill_fg = "#dbeafe", "#1e3a8a"
+            content = m2.group(1)
+            link_url = m2.group(2)
+
+        m3 = re.match(r'^ENG sent file:\s*(.*?)(?:\s*\(as [^)]+\))?(?:\s*<(.+?)>)?\s*$', raw, re.I)
+        if m3:
+            direction = "Engineer → Customer"
+            pill_bg, pill_fg = "#dcfce7", "#14532d"
+            content = m3.group(1)
+            link_url = m3.group(2)
+
+        safe = html.escape(content).replace("\n", "<br>")
+
+        if link_url:
+            if link_url.startswith("/"):
+                link_url = urljoin(ZULIP_BASE_URL, link_url)
+            safe += f'<br><a href="{html.escape(link_url)}" target="_blank" rel="noopener">Link to Media</a>'
+        else:
+            safe = linkify(safe)
+
+        card = f"""
+        <div style="border:1px solid #e5e7eb;border-radius:12px;padding:12px 14px;margin:10px 0;background:#ffffff;">
+          <div style="display:flex;align-items:center;justify-content:space-between;margin-bottom:6px;">
+            <span style="display:inline-block;padding:3px 10px;border-radius:999px;background:{pill_bg};color:{pill_fg};font-size:12px;font-weight:600;">
+              {html.escape(direction)}
+            </span>
+            <span style="font-size:12px;color:#6b7280;">#{i}</span>
+          </div>
+          <div style="font-size:14px;color:#111827;line-height:1.5;">{safe}</div>
+        </div>
+        """
+        cards.append(card)
+
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+  <meta charset="utf-8">
+  <title>Transcript #{ticket_id}</title>
+</head>
+<body style="background:#f9fafb;margin:0;padding:0;font-family:ui-sans-serif,system-ui,-apple-system,Segoe UI,Roboto,Ubuntu,Cantarell,Noto Sans,sans-serif;">
+  <div style="max-width:820px;margin:24px auto;padding:0 16px;">
+    <div style="margin-bottom:14px;">
+      <h2 style="margin:0 0 6px 0;font-size:20px;color:#111827;">WhatsApp ↔ Zulip Transcript</h2>
+      <div style="font-size:13px;color:#6b7280;">Ticket #{ticket_id}</div>
+    </div>
+    {''.join(cards)}
+  </div>
+</body>
+</html>"""
+
+
+def make_lines(n: int, seed: int = 1) -> list[str]:
+    rnd = random.Random(seed)
+    return [rnd.choice(SAMPLES) for _ in range(n)]
+
+
+def allocated(fn) -> int:
+    tracemalloc.start()
+    kept = fn()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return size
+
+
+def timeit(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main(sizes):
+    print(f"{'lines':>8} {'legacy ms':>12} {'new ms':>10} {'speedup':>8} {'html KiB':>9} "
+          f"{'B/line str':>11} {'B/line rec':>11}")
+    for n in sizes:
+        lines = make_lines(n)
+        # old lines carry no timestamp, so migrated records render identically
+        records = transcript.Lines(lines)
+        repeat = 20 if n <= 1000 else 3
+        old_html = legacy_format_transcript_html(7, lines)
+        new_html = transcript.render(7, records, ZULIP_BASE_URL)
+        assert old_html == new_html, f"output differs for {n} lines"
+        t_old = timeit(lambda: legacy_format_transcript_html(7, lines), repeat)
+        t_new = timeit(lambda: transcript.render(7, records, ZULIP_BASE_URL), repeat)
+        # fresh copies of every body, as if loaded from disk
+        mem_str = allocated(lambda: [("x" + s)[1:] for s in lines])
+        mem_rec = allocated(lambda: transcript.Lines(
+            transcript.Line(d, time.time(), ("x" + b)[1:], u and ("x" + u)[1:], m) for d, _, b, u, m in records))
+        print(f"{n:>8} {t_old * 1000:>12.2f} {t_new * 1000:>10.2f} {t_old / t_new:>7.2f}x {len(new_html) / 1024:>9.0f} "
+              f"{mem_str / n:>11.0f} {mem_rec / n:>11.0f}")
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [10, 1000, 100000])
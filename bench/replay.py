@@ -0,0 +1,229 @@
+"""
+Replay captured webhook traffic against local upstream stubs.
+
+Reads a capture written with CAPTURE_DIR (one file or the whole directory,
+see capture.py), starts the Graph / Zulip / RT stand-ins from bench/stubs.py
+and a bridge pointed at them, the same way bench_load.py does, and sends
+every recorded /webhook and /webhook/zulip request again with the recorded
+gaps between them divided by --speed (0 sends as fast as possible).
+WhatsApp webhooks are signed again with the bench app secret, and the
+captured bot address is mapped to the bench bot so its own posts are still
+ignored. Requests for one customer go out one at a time, in recorded order.
+
+    python bench/replay.py CAPTURE [--speed 1] [--concurrency 16] [--db-mode journal]
+                           [--limit 1000] [--latency-ms 20] [--json out.json]
+
+Reports per-endpoint status counts and latency percentiles (next to the
+bridge's own handling time recorded in the capture), how long the queue
+took to drain, calls per upstream and the final state as seen on /metrics.
+"""
+import argparse, base64, hashlib, hmac, json, os, queue, re, shutil, sys, tempfile, threading, time, zlib
+from collections import Counter
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+import bench_load, capture, stubs
+from bench_load import percentile
+
+STATE_METRICS = ("bridge_open_chats", "bridge_pending_intakes", "bridge_transcripts",
+                 "bridge_transcript_lines", "bridge_outbox_pending", "bridge_webhooks_shed_total")
+
+
+def prepare(header: dict, record: dict) -> tuple[str, bytes, dict, str] | None:
+    """
+    (path, body, headers, customer key) to send for a captured record, or
+    None when its body was not kept.
+    """
+    headers = {"Content-Type": record["headers"].get("Content-Type", "application/json")}
+    if "json" in record:
+        data = record["json"]
+        msg = data.get("message") if isinstance(data, dict) else None
+        if isinstance(msg, dict) and msg.get("sender_email") == header.get("bot_email"):
+            data = dict(data, message=dict(msg, sender_email=bench_load.BOT_EMAIL))
+        body = json.dumps(data).encode()
+    elif "body_b64" in record:
+        data, body = None, base64.b64decode(record["body_b64"])
+    else:
+        return None
+    if record["endpoint"] == "whatsapp":
+        headers["X-Hub-Signature-256"] = "sha256=" + hmac.new(
+            bench_load.APP_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    return record["path"], body, headers, _customer(record["endpoint"], data)
+
+
+def _customer(endpoint: str, data) -> str:
+    if not isinstance(data, dict):
+        return ""
+    if endpoint == "zulip":
+        msg = data.get("message", {})
+        return (msg.get("topic") or msg.get("subject") or "").split("|", 1)[0].strip()
+    for entry in data.get("entry", []):
+        for change in entry.get("changes", []):
+            for msg in change.get("value", {}).get("messages", []):
+                return msg.get("from", "")
+    return ""
+
+
+class Replayer:
+    """
+    Senders sharded by customer, like the bridge's own job queue, so one
+    customer's webhooks arrive in order while different customers overlap.
+    """
+    def __init__(self, url: str, concurrency: int):
+        self.url = url
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+        self._queues = [queue.Queue() for _ in range(concurrency)]
+        self._lock = threading.Lock()
+        self.latency_ms = {}   # endpoint -> [ms]
+        self.statuses = {}     # endpoint -> Counter
+        self.lag_ms = []       # how late requests went out against the schedule
+        for q in self._queues:
+            threading.Thread(target=self._sender, args=(q,), daemon=True).start()
+
+    def submit(self, endpoint: str, key: str, request: tuple, due: float):
+        self._queues[zlib.crc32(key.encode()) % len(self._queues)].put((endpoint, request, due))
+
+    def _sender(self, q: queue.Queue):
+        while True:
+            endpoint, (path, body, headers, _), due = q.get()
+            started = time.perf_counter()
+            try:
+                status = self.session.post(self.url + path, data=body, headers=headers, timeout=30).status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            elapsed = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self.latency_ms.setdefault(endpoint, []).append(elapsed)
+                self.statuses.setdefault(endpoint, Counter())[status] += 1
+                self.lag_ms.append(max(0.0, started - due) * 1000)
+            q.task_done()
+
+    def join(self):
+        for q in self._queues:
+            q.join()
+
+
+def scrape(url: str) -> dict:
+    """
+    STATE_METRICS from /metrics, labelled series summed.
+    """
+    out = {}
+    try:
+        text = requests.get(url + "/metrics", timeout=10).text
+    except requests.RequestException:
+        return out
+    for line in text.splitlines():
+        m = re.match(r"(\w+)(?:\{[^}]*\})? (\S+)$", line)
+        if m and m.group(1) in STATE_METRICS:
+            out[m.group(1)] = out.get(m.group(1), 0) + float(m.group(2))
+    return out
+
+
+def summary(values: list) -> dict:
+    return {"n": len(values), "p50": percentile(values, 0.5), "p90": percentile(values, 0.9),
+            "p99": percentile(values, 0.99), "max": max(values) if values else float("nan")}
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("capture", help="capture file or CAPTURE_DIR")
+    p.add_argument("--speed", type=float, default=1.0, help="1 = recorded pace, N = N times faster, 0 = no waiting")
+    p.add_argument("--concurrency", type=int, default=16, help="customers sent in parallel")
+    p.add_argument("--limit", type=int, default=0, help="replay only the first N requests")
+    p.add_argument("--db-mode", default="journal", choices=("json", "journal", "shards", "sqlite"))
+    p.add_argument("--port", type=int, default=5099)
+    p.add_argument("--bridge-cmd", default="{python} main.py",
+                   help="command that starts the bridge on {port}, see bench_load.py")
+    p.add_argument("--drain-timeout", type=float, default=120.0)
+    p.add_argument("--json", help="also write the report to this file")
+    p.add_argument("--keep", action="store_true", help="keep the state directory and bridge log")
+    stubs.add_arguments(p)
+    args = p.parse_args()
+
+    records = capture.read(args.capture)
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        raise SystemExit(f"no captured requests in {args.capture}")
+    prepared = [(r, prepare(h, r)) for h, r in records]
+    skipped = sum(req is None for _, req in prepared)
+
+    upstreams = stubs.from_arguments(args)
+    state_dir = tempfile.mkdtemp(prefix="bridge-replay-")
+    proc, url, log_path = bench_load.start_bridge(args, upstreams, state_dir)
+    replayer = Replayer(url, args.concurrency)
+
+    try:
+        t0 = records[0][1]["t"]
+        started = time.perf_counter()
+        for record, req in prepared:
+            if req is None:
+                continue
+            due = started + ((record["t"] - t0) / args.speed if args.speed else 0.0)
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            replayer.submit(record["endpoint"], req[3], req, due)
+        replayer.join()
+        sent_done = time.perf_counter()
+        drained = bench_load.Driver(url, 1).wait_idle(args.drain_timeout)
+        finished = time.perf_counter()
+        state = scrape(url)
+        state_size = bench_load.state_bytes(state_dir)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(3)
+        except Exception:
+            proc.kill()
+        for stub, _ in upstreams.values():
+            stub.stop()
+
+    recorded = {}
+    for _, record in records:
+        recorded.setdefault(record["endpoint"], []).append(record["ms"])
+    report = {
+        "capture": args.capture, "db_mode": args.db_mode, "speed": args.speed,
+        "requests": len(records) - skipped, "skipped": skipped,
+        "recorded_span_s": records[-1][1]["t"] - t0,
+        "send_s": sent_done - started, "drain_s": finished - sent_done, "drained": drained,
+        "schedule_lag_ms": summary(replayer.lag_ms),
+        "endpoints": {
+            name: {"latency_ms": summary(values),
+                   "recorded_handler_ms": summary(recorded.get(name, [])),
+                   "statuses": {str(k): v for k, v in sorted(replayer.statuses[name].items(), key=str)}}
+            for name, values in sorted(replayer.latency_ms.items())
+        },
+        "upstream_calls": {name: dict(stub.calls) for name, (stub, _) in upstreams.items()},
+        "state": state, "state_bytes": state_size,
+    }
+
+    print(f"replay:       {report['requests']} requests ({skipped} without a body skipped), "
+          f"db={args.db_mode}  speed={'max' if not args.speed else f'{args.speed:g}x'}")
+    print(f"timing:       recorded over {report['recorded_span_s']:.1f}s, sent in {report['send_s']:.2f}s, "
+          f"drained {report['drain_s']:.2f}s later" + ("" if drained else " (queue or outbox did NOT drain)")
+          + f", schedule lag p99 {report['schedule_lag_ms']['p99']:.1f} ms")
+    for name, ep in report["endpoints"].items():
+        lat, rec = ep["latency_ms"], ep["recorded_handler_ms"]
+        print(f"{name + ':':13} p50 {lat['p50']:.1f}  p90 {lat['p90']:.1f}  p99 {lat['p99']:.1f}  "
+              f"max {lat['max']:.1f} ms  (handler time when recorded: p50 {rec['p50']:.1f}  p99 {rec['p99']:.1f})  "
+              + " ".join(f"{k}={v}" for k, v in ep["statuses"].items()))
+    for name, calls in report["upstream_calls"].items():
+        print(f"{name + ':':13} {sum(calls.values())} calls  (" + " ".join(f"{k}={v}" for k, v in sorted(calls.items())) + ")")
+    print("final state:  " + "  ".join(f"{k.replace('bridge_', '')}={v:g}" for k, v in sorted(state.items()))
+          + f"  state files {state_size} bytes")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.keep:
+        print(f"kept {state_dir} (bridge log: {log_path})")
+    else:
+        shutil.rmtree(state_dir)
+
+
+if __name__ == "__main__":
+    main()
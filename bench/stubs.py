@@ -0,0 +1,234 @@
+"""
+Local stand-ins for the Graph API, Zulip and RT, for load tests.
+
+Each stub is a threaded HTTP server on 127.0.0.1 that answers the handful of
+endpoints the bridge calls, after an optional delay and with an optional
+error rate. Every request is counted, and message bodies that carry a
+"#load-<n>" marker are timestamped so the load driver can measure end-to-end
+delivery latency.
+
+    python bench/stubs.py [--latency-ms 20] [--error-rate 0.01]
+
+prints the three base URLs and serves until interrupted.
+"""
+import argparse, hashlib, json, random, re, threading, time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+MARKER_RE = re.compile(r"#load-(\d+)")
+MEDIA_BYTES = 48 * 1024
+UPSTREAMS = ("graph", "zulip", "rt")
+
+
+class Stub:
+    """
+    One upstream: routes are (method, regex, handler) tried in order, a
+    handler returns (status, json body or bytes).
+    """
+    def __init__(self, name: str, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0):
+        self.name = name
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.routes = []
+        self.calls = Counter()
+        self.errors = 0
+        self.delivered = {}   # marker -> time the message reached this upstream
+        self._lock = threading.Lock()
+        self._ids = iter(range(1, 1 << 62))
+        self.server = None
+
+    def route(self, method: str, pattern: str):
+        def register(fn):
+            self.routes.append((method, re.compile(pattern), fn))
+            return fn
+        return register
+
+    def next_id(self) -> int:
+        with self._lock:
+            return next(self._ids)
+
+    def mark(self, text: str):
+        now = time.perf_counter()
+        with self._lock:
+            for m in MARKER_RE.finditer(text or ""):
+                self.delivered.setdefault(int(m.group(1)), now)
+
+    def start(self) -> str:
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self, method: str):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                    body = self._read_chunked()
+                path = self.path.split("?", 1)[0]
+                if stub.latency_ms or stub.jitter_ms:
+                    time.sleep(max(0.0, random.gauss(stub.latency_ms, stub.jitter_ms)) / 1000)
+                for m, pattern, fn in stub.routes:
+                    match = pattern.fullmatch(path)
+                    if m == method and match:
+                        with stub._lock:
+                            stub.calls[fn.__name__] += 1
+                        if stub.error_rate and random.random() < stub.error_rate:
+                            with stub._lock:
+                                stub.errors += 1
+                            status, out = 500, {"error": "injected failure"}
+                        else:
+                            status, out = fn(self, body, *match.groups())
+                        break
+                else:
+                    status, out = 404, {"error": f"{stub.name}: no route for {method} {path}"}
+                data = out if isinstance(out, bytes) else json.dumps(out).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/octet-stream" if isinstance(out, bytes) else "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _read_chunked(self) -> bytes:
+                out = b""
+                while True:
+                    size = int(self.rfile.readline().strip(), 16)
+                    if size == 0:
+                        self.rfile.readline()
+                        return out
+                    out += self.rfile.read(size)
+                    self.rfile.readline()
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name=f"stub-{self.name}", daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def _form(body: bytes) -> dict:
+    return {k: v[0] for k, v in parse_qs(body.decode("utf-8", "replace")).items()}
+
+
+def graph_stub(**kw) -> Stub:
+    stub = Stub("graph", **kw)
+
+    @stub.route("POST", r"/(\w+)/messages")
+    def send_message(handler, body, phone_id):
+        payload = json.loads(body or b"{}")
+        if payload.get("status") == "read":
+            return 200, {"success": True}
+        stub.mark(json.dumps(payload))
+        return 200, {"messages": [{"id": f"wamid.stub{stub.next_id()}"}]}
+
+    @stub.route("POST", r"/(\w+)/media")
+    def upload_media(handler, body, phone_id):
+        return 200, {"id": f"media{stub.next_id()}"}
+
+    @stub.route("GET", r"/download/([\w.-]+)")
+    def download(handler, body, media_id):
+        return 200, b"\0" * MEDIA_BYTES
+
+    @stub.route("GET", r"/([\w.-]+)")
+    def media_info(handler, body, media_id):
+        base = f"http://127.0.0.1:{stub.server.server_port}"
+        return 200, {
+            "url": f"{base}/download/{media_id}",
+            "sha256": hashlib.sha256(media_id.encode()).hexdigest(),
+            "file_size": MEDIA_BYTES,
+        }
+
+    return stub
+
+
+def zulip_stub(**kw) -> Stub:
+    stub = Stub("zulip", **kw)
+
+    @stub.route("POST", r"/api/v1/messages")
+    def send_message(handler, body):
+        stub.mark(_form(body).get("content", ""))
+        return 200, {"result": "success", "id": stub.next_id()}
+
+    @stub.route("POST", r"/api/v1/user_uploads")
+    def upload(handler, body):
+        n = stub.next_id()
+        return 200, {"result": "success", "uri": f"/user_uploads/1/{n:02x}/upload{n}.bin"}
+
+    @stub.route("GET", r"/user_uploads/(.+)")
+    def download(handler, body, path):
+        return 200, b"x" * MEDIA_BYTES
+
+    return stub
+
+
+def rt_stub(**kw) -> Stub:
+    stub = Stub("rt", **kw)
+
+    @stub.route("POST", r"/ticket")
+    def create_ticket(handler, body):
+        return 201, {"id": stub.next_id(), "type": "ticket"}
+
+    @stub.route("POST", r"/ticket/(\d+)/comment")
+    def comment(handler, body, ticket_id):
+        return 201, ["Comments added"]
+
+    return stub
+
+
+def start_all(latency_ms: dict, jitter_ms: float, error_rate: dict) -> dict:
+    """
+    Start the three stubs. Returns {name: (stub, base_url)}.
+    """
+    out = {}
+    for name, factory in (("graph", graph_stub), ("zulip", zulip_stub), ("rt", rt_stub)):
+        stub = factory(latency_ms=latency_ms[name], jitter_ms=jitter_ms, error_rate=error_rate[name])
+        out[name] = (stub, stub.start())
+    return out
+
+
+def add_arguments(p: argparse.ArgumentParser):
+    p.add_argument("--latency-ms", type=float, default=20.0, help="mean delay per upstream call")
+    p.add_argument("--jitter-ms", type=float, default=5.0, help="standard deviation of the delay")
+    p.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with a 500")
+    for name in UPSTREAMS:
+        p.add_argument(f"--{name}-latency-ms", type=float, default=None, help=f"override --latency-ms for {name}")
+        p.add_argument(f"--{name}-error-rate", type=float, default=None, help=f"override --error-rate for {name}")
+
+
+def from_arguments(args) -> dict:
+    def pick(name, attr):
+        value = getattr(args, f"{name}_{attr}")
+        return getattr(args, attr) if value is None else value
+    return start_all(
+        {n: pick(n, "latency_ms") for n in UPSTREAMS},
+        args.jitter_ms,
+        {n: pick(n, "error_rate") for n in UPSTREAMS},
+    )
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(p)
+    stubs = from_arguments(p.parse_args())
+    print(f"GRAPH_API_URL={stubs['graph'][1]}")
+    print(f"ZULIP_BASE_URL={stubs['zulip'][1]}")
+    print(f"RT_BASE_URL={stubs['rt'][1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
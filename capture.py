@@ -0,0 +1,261 @@
+"""
+Webhook capture for record-and-replay (CAPTURE_DIR).
+
+Every /webhook and /webhook/zulip request is written, with its headers, the
+time it arrived, how long the bridge took and the status it answered, to a
+gzip-compressed JSON-lines file in CAPTURE_DIR. Records are handed to a
+writer thread, so a slow disk never holds up a webhook (when its queue is
+full records are dropped and counted). A file is closed and a new one started
+after CAPTURE_MAX_BYTES of records; only the newest CAPTURE_KEEP files are
+kept. bench/replay.py plays the files back against the upstream stubs.
+
+With CAPTURE_MASK phone numbers, e-mail addresses and names are replaced by
+stable pseudonyms (the same customer keeps the same fake number, so chats
+still line up on replay); CAPTURE_MASK_TEXT also blanks message text,
+keeping `!commands`, upload links and `RT #n` so the bridge takes the same
+paths. Signatures and tokens are never written: replay signs requests again.
+"""
+import base64, glob, gzip, hashlib, hmac, json, os, queue, re, threading, time
+import metrics
+
+FORMAT = 1
+SKIP_HEADERS = {"x-hub-signature", "x-hub-signature-256", "authorization", "cookie"}
+
+RECORDED = metrics.Counter("bridge_capture_records_total", "Webhooks written to the capture file.", ("endpoint",))
+DROPPED  = metrics.Counter("bridge_capture_dropped_total", "Webhooks not captured because the writer fell behind.")
+
+_EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+# parts of a message the bridge acts on, kept by CAPTURE_MASK_TEXT
+_KEEP_RE  = re.compile(r"!\w+|\[[^\]]*\]\(/user_uploads/[^)]*\)|\bRT\s*#?\d+|" + _EMAIL_RE.pattern, re.I)
+_WORD_RE  = re.compile(r"[^\W_]")
+PHONE_KEYS = ("from", "wa_id", "recipient_id")
+NAME_KEYS  = ("name", "sender_full_name", "full_name")
+TEXT_KEYS  = ("body", "caption", "filename", "content")
+TOPIC_KEYS = ("topic", "subject")
+
+
+class Masker:
+    """
+    Deterministic pseudonyms keyed with `secret`: the same input always gives
+    the same output, across restarts and worker processes.
+    """
+    def __init__(self, secret: str, text: bool = False):
+        self._secret = secret.encode()
+        self.text = text
+
+    def _digest(self, value: str) -> str:
+        return hmac.new(self._secret, value.encode(), hashlib.sha256).hexdigest()
+
+    def phone(self, value: str) -> str:
+        return "999" + str(int(self._digest(value)[:15], 16))[:9]
+
+    def email(self, value: str) -> str:
+        return f"user-{self._digest(value.lower())[:10]}@masked.invalid"
+
+    def _blank(self, value: str) -> str:
+        out, last = [], 0
+        for m in _KEEP_RE.finditer(value):
+            out.append(_WORD_RE.sub(lambda c: "0" if c.group().isdigit() else "x", value[last:m.start()]))
+            out.append(m.group())
+            last = m.end()
+        out.append(_WORD_RE.sub(lambda c: "0" if c.group().isdigit() else "x", value[last:]))
+        return "".join(out)
+
+    def _topic(self, value: str) -> str:
+        # "<phone> | <subject>": the phone is what routes an engineer reply
+        phone, sep, subject = value.partition("|")
+        return phone + sep + (self._blank(subject) if self.text else subject)
+
+    def _walk(self, node, phones: dict):
+        if isinstance(node, list):
+            return [self._walk(v, phones) for v in node]
+        if not isinstance(node, dict):
+            return node
+        out = {}
+        for k, v in node.items():
+            if isinstance(v, str) and k in PHONE_KEYS:
+                v = phones.setdefault(v, self.phone(v))
+            elif isinstance(v, str) and k in NAME_KEYS:
+                v = "Masked"
+            elif isinstance(v, str) and k in TOPIC_KEYS:
+                v = self._topic(v)
+            elif isinstance(v, str) and k in TEXT_KEYS and self.text:
+                v = self._blank(v)
+            else:
+                v = self._walk(v, phones)
+            out[k] = v
+        return out
+
+    def body(self, data: dict) -> dict:
+        phones = {}
+        data = self._walk(data, phones)
+        # phones also turn up in topics and text, e.g. "447700900123 | printer"
+        raw = json.dumps(data)
+        for real in _topic_phones(data):
+            phones.setdefault(real, self.phone(real))
+        for real, fake in phones.items():
+            if real.isdigit() and len(real) >= 6:
+                raw = re.sub(rf"(?<!\d){real}(?!\d)", fake, raw)
+        raw = _EMAIL_RE.sub(lambda m: self.email(m.group()), raw)
+        return json.loads(raw)
+
+
+def _topic_phones(node) -> list[str]:
+    found = []
+    if isinstance(node, dict):
+        for k, v in node.items():
+            if k in TOPIC_KEYS and isinstance(v, str):
+                phone = v.partition("|")[0].strip()
+                if phone.isdigit():
+                    found.append(phone)
+            else:
+                found.extend(_topic_phones(v))
+    elif isinstance(node, list):
+        for v in node:
+            found.extend(_topic_phones(v))
+    return found
+
+
+def _scrub(data: dict) -> dict:
+    # zulip's outgoing webhook token
+    return dict(data, token="redacted") if "token" in data else data
+
+
+class Recorder:
+    def __init__(self, directory: str, max_bytes: int = 64 * 1024 * 1024, keep: int = 10,
+                 masker: Masker | None = None, meta: dict | None = None, queue_size: int = 10000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.masker = masker
+        self.meta = meta or {}
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file = None
+        self._written = 0
+        self._seq = 0
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, endpoint: str, path: str, headers, body: bytes, status: int, started: float, seconds: float):
+        """
+        Queue one webhook for the writer thread. Never blocks.
+        """
+        self._start()
+        try:
+            self._queue.put_nowait((endpoint, path, list(headers), body, status, started, seconds))
+        except queue.Full:
+            DROPPED.inc()
+
+    def _start(self):
+        # started lazily and again in a forked worker (threads don't survive a fork)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._file = None
+            self._thread = threading.Thread(target=self._run, name="capture", daemon=True)
+            self._thread.start()
+
+    def _encode(self, endpoint, path, headers, body, status, started, seconds) -> str:
+        record = {"t": round(started, 6), "endpoint": endpoint, "path": path,
+                  "headers": {k: v for k, v in headers if k.lower() not in SKIP_HEADERS},
+                  "status": status, "ms": round(seconds * 1000, 3)}
+        try:
+            data = _scrub(json.loads(body))
+            if self.masker:
+                data = self.masker.body(data)
+            record["json"] = data
+        except ValueError:
+            if self.masker:
+                record["body_bytes"] = len(body)   # unknown shape, not kept when masking
+            else:
+                record["body_b64"] = base64.b64encode(body).decode()
+        return json.dumps(record, separators=(",", ":")) + "\n"
+
+    def _open(self):
+        self._seq += 1
+        name = time.strftime("capture-%Y%m%d-%H%M%S", time.gmtime()) + f"-{os.getpid()}-{self._seq:04d}.jsonl.gz"
+        self._file = gzip.open(os.path.join(self.directory, name), "wt")
+        self._written = 0
+        header = dict(self.meta, capture=FORMAT, started=time.time(), masked=bool(self.masker),
+                      masked_text=bool(self.masker and self.masker.text))
+        self._file.write(json.dumps(header) + "\n")
+        files = sorted(glob.glob(os.path.join(self.directory, "capture-*.jsonl.gz")))
+        for old in files[:-self.keep] if self.keep else []:
+            os.remove(old)
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item = self._queue.get(timeout=1)
+            except queue.Empty:
+                item = None
+            try:
+                if item == "close":
+                    if self._file:
+                        self._file.close()
+                        self._file = None
+                    self._closed.set()
+                    continue
+                if item is not None:
+                    if self._file is None:
+                        self._open()
+                    line = self._encode(*item)
+                    self._file.write(line)
+                    self._written += len(line)
+                    RECORDED.inc(item[0])
+                if self._file and (self._written >= self.max_bytes or time.monotonic() - last_flush > 1):
+                    # a sync flush every second keeps the file readable up to there after a crash
+                    self._file.flush()
+                    last_flush = time.monotonic()
+                    if self._written >= self.max_bytes:
+                        self._file.close()
+                        self._file = None
+            except Exception as e:
+                print("Capture write failed:", repr(e))
+
+    def close(self):
+        """
+        Write what is queued and close the current file.
+        """
+        if self._pid != os.getpid():
+            return
+        self._closed.clear()
+        try:
+            self._queue.put("close", timeout=5)
+        except queue.Full:
+            return
+        self._closed.wait(5)
+
+
+def read(path: str):
+    """
+    (header, record) pairs from a capture file, or from every capture file in
+    a directory, in arrival order. A file cut short by a crash is read up to
+    where it ends.
+    """
+    paths = sorted(glob.glob(os.path.join(path, "capture-*.jsonl.gz"))) if os.path.isdir(path) else [path]
+    records = []
+    for p in paths:
+        header = {}
+        with gzip.open(p, "rt") as f:
+            try:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                    except ValueError:
+                        break
+                    if "capture" in item:
+                        header = item
+                    else:
+                        records.append((header, item))
+            except (EOFError, OSError):
+                pass
+    records.sort(key=lambda r: r[1]["t"])
+    return records
@@ -1,53 +1,705 @@
-import json, os, threading
+import atexit, heapq, json, os, threading, time
+from contextlib import contextmanager
+import metrics, transcript
 
 DATA_FILE = os.getenv("BRIDGE_DB_FILE", "./bridge_state.json")
 _lock     = threading.RLock()
+# held while a snapshot (or a batch of shard files) is copied and written;
+# _lock is only taken inside it for the copy, so handlers wait for the copy
+# but never for the disk. never take _write_lock while holding _lock.
+_write_lock = threading.Lock()
+_snap_requests = 0   # _write_snapshot() calls so far
+_snap_covered  = 0   # calls covered by the last snapshot written
+
+# "json" rewrites DATA_FILE on every change, "journal" appends each change to
+# JOURNAL_FILE and only rewrites DATA_FILE when the journal is compacted,
+# "shards" writes only the changed entries, one file each, under SHARD_DIR,
+# "sqlite" keeps everything in SQLITE_FILE (shared by all gunicorn workers)
+DB_MODE      = os.getenv("BRIDGE_DB_MODE", "json").lower()
+JOURNAL_FILE = DATA_FILE + ".log"
+# the journal being compacted, kept until its snapshot is on disk
+OLD_JOURNAL_FILE = JOURNAL_FILE + ".old"
+SQLITE_FILE  = os.getenv("BRIDGE_SQLITE_FILE", os.path.splitext(DATA_FILE)[0] + ".sqlite3")
+SHARD_DIR    = os.getenv("BRIDGE_SHARD_DIR", os.path.splitext(DATA_FILE)[0] + ".shards")
+JOURNAL_COMPACT_BYTES   = int(os.getenv("BRIDGE_JOURNAL_COMPACT_BYTES", str(4 * 1024 * 1024)))
+JOURNAL_COMPACT_SECONDS = int(os.getenv("BRIDGE_JOURNAL_COMPACT_SECONDS", "300"))
+# "segments" keeps transcripts out of `state`, in per-ticket segment files
+# under TRANSCRIPT_DIR that are only read when a ticket is pushed or appended
+# to (file modes; sqlite mode already keeps them in a table)
+TRANSCRIPT_STORE = os.getenv("BRIDGE_TRANSCRIPT_STORE", "memory").lower()
+TRANSCRIPT_DIR   = os.getenv("BRIDGE_TRANSCRIPT_DIR", os.path.splitext(DATA_FILE)[0] + ".transcripts")
+# file modes keep the webhook dedup ids in their own append-only file, out of
+# `state` and its snapshots (sqlite mode has them in a table)
+SEEN_FILE = os.getenv("BRIDGE_SEEN_FILE", os.path.splitext(DATA_FILE)[0] + ".seen.jsonl")
+# write-behind for the file modes: with FLUSH_MS > 0 a change only marks state
+# dirty and a background thread writes out everything pending at most every
+# FLUSH_MS milliseconds, or straight away once FLUSH_MAX_CHANGES are pending.
+# flush() is the barrier for callers that need a change on disk. 0 writes
+# every change through (sqlite mode always commits as it goes).
+FLUSH_MS          = int(os.getenv("BRIDGE_DB_FLUSH_MS", "0"))
+FLUSH_MAX_CHANGES = int(os.getenv("BRIDGE_DB_FLUSH_MAX_CHANGES", "1000"))
+
+_journal_fh   = None
+_journal_seq  = 0     # seq of the last record written or replayed
+_journal_size = 0
+_last_compact = time.time()
+_journal_buf  = []    # journal lines not written yet (write-behind)
+
+_unflushed   = 0      # changes applied to `state` but not on disk yet
+_flushing    = 0      # flush() calls writing changes out right now
+_flushed     = threading.Condition(_lock)
+_tx_depth    = 0      # transaction() nesting of the thread holding _lock
+_flusher_pid = None   # pid that started the flush thread (threads don't survive a fork)
+_flush_wake  = threading.Event()
+
+# shards mode: (coll, key) -> list items appended since the last flush, or
+# None when the entry has to be rewritten (or deleted)
+_dirty = {}
+
+# min-heap of (last_customer_ts, phone) over phone_to_chat so expiry never has
+# to scan every chat; entries made stale by a newer timestamp or a removed
+# chat are skipped when they reach the top
+_deadlines = []
+
+# top-level collections, each a dict keyed by phone, ticket or message id
+COLLECTIONS = ("phone_to_chat", "transcripts", "pending_rts", "push_cursors", "seen_messages", "outbox")
 
 def _default():
-    return {
-        "phone_to_chat": {},
-        "transcripts": {},
-        "pending_rts": {}
-    }
+    return {coll: {} for coll in COLLECTIONS}
+
+def _apply(s: dict, op: str, coll: str, key: str, value=None):
+    if op == "put":
+        s.setdefault(coll, {})[key] = value
+    elif op == "pop":
+        s.setdefault(coll, {}).pop(key, None)
+    elif op in ("append", "extend"):
+        items = s.setdefault(coll, {}).get(key)
+        if items is None:
+            items = s[coll][key] = transcript.Lines() if coll == "transcripts" else []
+        if op == "append":
+            items.append(value)
+        else:
+            items.extend(value)
+
+def _typed_transcripts(s: dict):
+    # transcript lines as records, old string lines included
+    s["transcripts"] = {k: transcript.Lines(v) for k, v in s.get("transcripts", {}).items()}
+
+def _replay(s: dict, after_seq: int) -> int:
+    """
+    Apply journal records newer than `after_seq` to `s`, return the last seq.
+    A torn last line (crash mid-write) is ignored.
+    """
+    last = after_seq
+    for path in (OLD_JOURNAL_FILE, JOURNAL_FILE):
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            for line in f:
+                try:
+                    seq, op, coll, key, *value = json.loads(line)
+                except ValueError:
+                    break
+                if seq <= last:
+                    continue
+                _apply(s, op, coll, key, value[0] if value else None)
+                last = seq
+    return last
 
 # load state from disk
-def _load():
-    if not os.path.exists(DATA_FILE):
-        return _default()
-    try:
-        with open(DATA_FILE) as f:
-            raw = json.load(f)
-            return {
-                "phone_to_chat": raw.get("phone_to_chat", {}),
-                "transcripts": raw.get("transcripts", {}),
-                "pending_rts": raw.get("pending_rts", {})
-            }
-    except Exception:
-        return _default()
+def _load(replay: bool = DB_MODE == "journal"):
+    global _journal_seq
+    s, snap_seq = _default(), 0
+    if os.path.exists(DATA_FILE):
+        try:
+            with open(DATA_FILE) as f:
+                raw = json.load(f)
+                s = {coll: raw.get(coll, {}) for coll in COLLECTIONS}
+                snap_seq = raw.get("journal_seq", 0)
+        except Exception:
+            s = _default()
+    if replay:
+        _journal_seq = _replay(s, snap_seq)
+    return s
+
+_shards = None
+if DB_MODE == "sqlite":
+    import db_sqlite as _sql
+    # first start on SQLite imports the existing JSON snapshot + journal once
+    _sql.init(SQLITE_FILE, seed=lambda: _load(replay=True))
+    state = _default()   # unused, kept so old callers don't crash
+elif DB_MODE == "shards":
+    import db_shards as _shards
+    _sql = None
+    # likewise, the first start writes the JSON snapshot + journal out as shards
+    state = _shards.init(SHARD_DIR, COLLECTIONS, seed=lambda: _load(replay=True))
+    _typed_transcripts(state)
+else:
+    _sql = None
+    state = _load()
+    _typed_transcripts(state)
+
+def _index_chat(phone: str, chat: dict | None):
+    ts = (chat or {}).get("last_customer_ts")
+    if ts:
+        heapq.heappush(_deadlines, (ts, phone))
+
+def _rebuild_deadlines():
+    _deadlines[:] = [
+        (c["last_customer_ts"], p) for p, c in state.get("phone_to_chat", {}).items()
+        if c.get("last_customer_ts")
+    ]
+    heapq.heapify(_deadlines)
 
-state = _load()
+def _deadline_is_current(ts: float, phone: str) -> bool:
+    chat = state.get("phone_to_chat", {}).get(phone)
+    return chat is not None and chat.get("last_customer_ts") == ts
+
+if not _sql:
+    _rebuild_deadlines()
+
+_dedup = None
+if not _sql:
+    import db_seen as _dedup
+    _dedup.init(SEEN_FILE, seed=state.get("seen_messages"))
+
+_segments = None
+if not _sql and TRANSCRIPT_STORE == "segments":
+    import db_segments as _segments
+    _segments.init(TRANSCRIPT_DIR)
+
+def _copy_state() -> dict:
+    """
+    Copy of `state` to write out, taken under _lock. Stored values are never
+    changed in place (puts store a copy, reads hand one out), so copying the
+    collection dicts is enough; transcripts grow in place and are copied.
+    """
+    out = {coll: dict(state.get(coll, {})) for coll in COLLECTIONS if coll != "seen_messages"}
+    out["transcripts"] = {k: v.copy() for k, v in out["transcripts"].items()}
+    out["journal_seq"] = _journal_seq
+    return out
+
+def _write_snapshot(on_copy=None, on_written=None):
+    """
+    Copy state under _lock, then encode and write the copy without it, so
+    changes aren't held up while a large state is serialised. `on_copy` runs
+    under _lock right after the copy, `on_written` once the file is in place.
+    Calls that overlap a write wait for it, and are skipped when a snapshot
+    copied after they were made is on disk by then.
+    """
+    global _snap_requests, _snap_covered
+    os.makedirs(os.path.dirname(DATA_FILE) or ".", exist_ok=True)
+    with _lock:
+        _snap_requests += 1
+        request = _snap_requests
+    with _write_lock:
+        if _snap_covered >= request:
+            return
+        with _lock:
+            serialisable = _copy_state()
+            if on_copy:
+                on_copy()
+            covers = _snap_requests
+        started = time.perf_counter()
+        tmp = DATA_FILE + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(serialisable, f, default=list)   # transcript.Lines -> list of records
+            written = f.tell()
+        os.replace(tmp, DATA_FILE)
+        if on_written:
+            on_written()
+        _snap_covered = covers
+    metrics.DB_WRITE_SECONDS.observe(time.perf_counter() - started, "snapshot")
+    metrics.DB_WRITE_BYTES.inc("snapshot", amount=written)
+
+def _mark_dirty(op: str, coll: str, key: str, value):
+    pending = _dirty.get((coll, key), 0)
+    if op in ("append", "extend") and pending is not None:
+        _dirty[(coll, key)] = pending + (1 if op == "append" else len(value))
+    else:
+        _dirty[(coll, key)] = None
+
+def _flush_dirty():
+    """
+    Shards mode: write out the entries changed since the last flush.
+    """
+    with _write_lock:
+        with _lock:
+            if not _dirty:
+                return
+            # take what to write under _lock (appended lines, or a copy of the
+            # entry), write it without
+            todo = []
+            for (coll, key), appended in _dirty.items():
+                value = state.get(coll, {}).get(key)
+                if isinstance(value, transcript.Lines):
+                    value = value[len(value) - appended:] if appended is not None else value.copy()
+                todo.append((coll, key, value, appended))
+            _dirty.clear()
+        started = time.perf_counter()
+        written = done = 0
+        try:
+            for coll, key, value, appended in todo:
+                written += _shards.write(coll, key, value, appended and len(value))
+                done += 1
+        finally:
+            if done < len(todo):
+                # rewrite whatever didn't make it on the next flush
+                with _lock:
+                    for coll, key, _, _ in todo[done:]:
+                        _dirty[(coll, key)] = None
+    metrics.DB_WRITE_SECONDS.observe(time.perf_counter() - started, "shards")
+    metrics.DB_WRITE_BYTES.inc("shards", amount=written)
+
+def compact():
+    """
+    Write a full snapshot and start a new journal. The old one is kept as
+    OLD_JOURNAL_FILE until the snapshot is on disk and both are replayed on
+    load, skipping records the snapshot covers, so a crash at any point is safe.
+    """
+    def rotate():
+        global _journal_fh, _journal_size, _last_compact, _unflushed
+        # buffered lines are covered by the snapshot
+        _journal_buf.clear()
+        _unflushed = 0
+        if _journal_fh:
+            _journal_fh.close()
+        if os.path.exists(JOURNAL_FILE):
+            if os.path.exists(OLD_JOURNAL_FILE):
+                # an earlier compaction never finished: keep its records too
+                _truncate_torn(OLD_JOURNAL_FILE)
+                with open(OLD_JOURNAL_FILE, "a") as old, open(JOURNAL_FILE) as cur:
+                    old.write(cur.read())
+                os.remove(JOURNAL_FILE)
+            else:
+                os.replace(JOURNAL_FILE, OLD_JOURNAL_FILE)
+        _journal_fh = open(JOURNAL_FILE, "w")
+        _journal_size = 0
+        _last_compact = time.time()
+
+    def drop_old():
+        if os.path.exists(OLD_JOURNAL_FILE):
+            os.remove(OLD_JOURNAL_FILE)
+
+    _write_snapshot(on_copy=rotate, on_written=drop_old)
+
+def maybe_compact():
+    """
+    Compact when the journal is large or has been growing for a while.
+    Called from the write path and from the periodic cleanup loop.
+    """
+    if _sql:
+        _sql.checkpoint()
+        return
+    if DB_MODE != "journal":
+        return
+    with _lock:
+        due = ((_journal_size or _journal_buf)
+               and (_journal_size >= JOURNAL_COMPACT_BYTES
+                    or time.time() - _last_compact >= JOURNAL_COMPACT_SECONDS))
+    if due:
+        compact()
 
 # Save state to disk
 def save():
     """
-    Atomically write `state` to disk.
+    Atomically write `state` to disk. In journal mode this is a compaction,
+    in shards mode only changed entries are written, in sqlite mode every
+    change is already committed.
     """
-    os.makedirs(os.path.dirname(DATA_FILE) or ".", exist_ok=True)
+    global _unflushed
+    if _sql:
+        return
+    if DB_MODE == "journal":
+        compact()
+        return
+    with _lock:
+        _unflushed += 1   # write even if nothing changed
+    flush()
 
-    serialisable = {
-        "phone_to_chat": state.get("phone_to_chat", {}),
-        "transcripts": state.get("transcripts", {}),
-        "pending_rts": state.get("pending_rts", {})
-    }
+def _truncate_torn(path: str):
+    # cut a torn last line (crash mid-write) off before appending after it,
+    # or replay would stop there and skip everything appended later
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
 
-    tmp = DATA_FILE + ".tmp"
+def _write_journal():
+    global _journal_fh, _journal_size
+    if not _journal_buf:
+        return
+    if _journal_fh is None:
+        os.makedirs(os.path.dirname(JOURNAL_FILE) or ".", exist_ok=True)
+        if os.path.exists(JOURNAL_FILE):
+            _truncate_torn(JOURNAL_FILE)
+        _journal_fh = open(JOURNAL_FILE, "a")
+        _journal_size = _journal_fh.tell()
+    started = time.perf_counter()
+    data = "".join(_journal_buf)
+    _journal_fh.write(data)
+    _journal_fh.flush()
+    _journal_buf.clear()
+    _journal_size += len(data)
+    metrics.DB_WRITE_SECONDS.observe(time.perf_counter() - started, "journal")
+    metrics.DB_WRITE_BYTES.inc("journal", amount=len(data))
+
+def flush():
+    """
+    Return once every change made so far is on disk. Only does work with
+    write-behind (BRIDGE_DB_FLUSH_MS); call it before telling anyone a change
+    is done.
+    """
+    global _unflushed, _flushing
+    if _sql:
+        return
     with _lock:
-        with open(tmp, "w") as f:
-            json.dump(serialisable, f)
-        os.replace(tmp, DATA_FILE)
+        if not _unflushed:
+            # changes taken by another flush() may still be on their way out
+            while _flushing:
+                _flushed.wait()
+            return
+        _unflushed = 0
+        if DB_MODE == "journal":
+            _write_journal()
+            if _journal_size < JOURNAL_COMPACT_BYTES:
+                return
+        _flushing += 1
+    try:
+        if _shards:
+            _flush_dirty()
+        elif DB_MODE == "journal":
+            compact()
+        else:
+            _write_snapshot()
+    except Exception:
+        with _lock:
+            _unflushed += 1   # try again on the next flush
+        raise
+    finally:
+        with _lock:
+            _flushing -= 1
+            _flushed.notify_all()
+
+def _start_flusher():
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+
+    def loop():
+        while True:
+            _flush_wake.wait(FLUSH_MS / 1000)
+            _flush_wake.clear()
+            try:
+                flush()
+            except Exception as e:
+                print("State flush error:", e)
+
+    _flusher_pid = os.getpid()
+    threading.Thread(target=loop, name="db-flush", daemon=True).start()
+    print(f"State write-behind started (every {FLUSH_MS} ms or {FLUSH_MAX_CHANGES} changes)")
+
+atexit.register(flush)
+
+def _spill_transcripts():
+    """
+    Segments mode: move transcripts still held in `state` (from before the
+    switch) out to segment files, once.
+    """
+    moved = state.get("transcripts", {})
+    if not moved:
+        return
+    on_disk = set(_segments.tickets())
+    for ticket, lines in moved.items():
+        if ticket not in on_disk:   # else a crash beat the save below
+            _segments.extend(ticket, lines)
+        if _shards:
+            _dirty[("transcripts", ticket)] = None
+    state["transcripts"] = {}
+    save()
+    print(f"Moved {len(moved)} transcripts to {TRANSCRIPT_DIR}")
+
+if _segments:
+    _spill_transcripts()
+
+def _drop_seen_from_state():
+    """
+    Ids kept in `state` by older versions were imported by db_seen; drop
+    them from the state files, once.
+    """
+    seen = state.get("seen_messages", {})
+    if not seen:
+        return
+    if _shards:
+        for key in seen:
+            _dirty[("seen_messages", key)] = None
+    state["seen_messages"] = {}
+    save()
+
+if _dedup:
+    _drop_seen_from_state()
 
-def append_transcript_line(ticket_id: int, line: str):
+def _record(op: str, coll: str, key: str, value=None):
+    """
+    Apply one mutation to `state` and persist it: a single appended line in
+    journal mode, the one changed entry in shards mode, a full save otherwise.
+    With write-behind the write happens later, batched with other changes.
+    """
+    global _journal_seq, _unflushed
+    if _sql:
+        with metrics.DB_WRITE_SECONDS.time("sqlite"):
+            _sql.record(op, coll, key, value)
+        return
+    if op == "put" and isinstance(value, dict):
+        value = dict(value)   # the caller may keep changing its dict
+    with _lock:
+        _apply(state, op, coll, key, value)
+        if coll == "phone_to_chat" and op == "put":
+            _index_chat(key, value)
+            if len(_deadlines) > 2 * len(state["phone_to_chat"]) + 64:
+                _rebuild_deadlines()
+        if _shards:
+            _mark_dirty(op, coll, key, value)
+        elif DB_MODE == "journal":
+            _journal_seq += 1
+            rec = [_journal_seq, op, coll, key] + ([value] if op != "pop" else [])
+            _journal_buf.append(json.dumps(rec, separators=(",", ":")) + "\n")
+        _unflushed += 1
+        if FLUSH_MS > 0:
+            _start_flusher()
+            if _unflushed >= FLUSH_MAX_CHANGES:
+                _flush_wake.set()
+            return
+        if _tx_depth:
+            return   # written when the outermost transaction() exits
+    flush()
+
+@contextmanager
+def transaction():
+    """
+    Make several mutations atomic: one SQLite transaction, or `_lock` held
+    for the file modes. Writing them out waits until the outermost
+    transaction has let go of `_lock`.
+    """
+    global _tx_depth
+    if _sql:
+        with _sql.transaction():
+            yield
+        return
+    with _lock:
+        _tx_depth += 1
+        outermost = _tx_depth == 1
+        try:
+            yield
+        finally:
+            _tx_depth -= 1
+    if outermost and FLUSH_MS <= 0:
+        flush()
+
+def _own(value):
+    # callers get their own copy of a stored dict (see _copy_state)
+    return dict(value) if isinstance(value, dict) else value
+
+def _get(coll: str, key: str):
+    if _sql:
+        return _sql.get(coll, key)
+    with _lock:
+        return _own(state.get(coll, {}).get(key))
+
+def get_chat(phone: str) -> dict | None:
+    return _get("phone_to_chat", phone)
+
+def chats() -> dict:
+    """
+    Snapshot of phone -> chat, safe to iterate while chats are added/removed.
+    """
+    if _sql:
+        return _sql.items("phone_to_chat")
+    with _lock:
+        return {phone: dict(chat) for phone, chat in state.get("phone_to_chat", {}).items()}
+
+def oldest_customer_ts() -> float | None:
+    """
+    Earliest `last_customer_ts` over open chats, i.e. the next expiry deadline
+    minus the TTL. O(1) amortised.
+    """
+    if _sql:
+        return _sql.min_value("phone_to_chat", "last_customer_ts")
+    with _lock:
+        while _deadlines and not _deadline_is_current(*_deadlines[0]):
+            heapq.heappop(_deadlines)
+        return _deadlines[0][0] if _deadlines else None
+
+def take_idle_chats(before: float) -> list[tuple[str, dict]]:
+    """
+    (phone, chat) for every chat whose last customer message is older than
+    `before`, oldest first. Each chat is returned once per timestamp, so the
+    caller must expire (or re-touch) what it gets. Cost grows with the number
+    of chats returned, not with the number of open chats.
+    """
+    if _sql:
+        return _sql.older_than("phone_to_chat", "last_customer_ts", before)
+    idle = []
+    with _lock:
+        while _deadlines and _deadlines[0][0] < before:
+            ts, phone = heapq.heappop(_deadlines)
+            if _deadline_is_current(ts, phone):
+                idle.append((phone, dict(state["phone_to_chat"][phone])))
+    return idle
+
+def sizes() -> dict:
+    """
+    Row counts per collection, plus "transcript_lines" (lines over all tickets).
+    """
+    if _sql:
+        return _sql.sizes()
+    with _lock:
+        out = {coll: len(state.get(coll, {})) for coll in COLLECTIONS}
+        out["seen_messages"] = _dedup.size()
+        out["transcript_lines"] = sum(len(v) for v in state.get("transcripts", {}).values())
+    if _segments:
+        out.update(_segments.sizes())
+    return out
+
+def get_pending(phone: str) -> dict | None:
+    return _get("pending_rts", phone)
+
+def get_transcript(ticket_id: int, start: int = 0) -> list[transcript.Line]:
+    """
+    Transcript lines from index `start` on.
+    """
+    if _sql:
+        return [transcript.Line.load(v) for v in _sql.get_list("transcripts", str(ticket_id), start)]
+    if _segments:
+        return [transcript.Line.load(v) for v in _segments.read(str(ticket_id), start)]
     with _lock:
-        state.setdefault("transcripts", {}).setdefault(str(ticket_id), []).append(line)
-        save()
+        return state.get("transcripts", {}).get(str(ticket_id), [])[start:]
 
+def get_push_cursor(ticket_id: int) -> int:
+    """
+    Number of transcript lines already posted to RT.
+    """
+    return _get("push_cursors", str(ticket_id)) or 0
+
+def set_push_cursor(ticket_id: int, pushed: int):
+    _record("put", "push_cursors", str(ticket_id), pushed)
+
+def put_chat(phone: str, chat: dict):
+    _record("put", "phone_to_chat", phone, chat)
+
+def pop_chat(phone: str):
+    _record("pop", "phone_to_chat", phone)
+
+def put_pending(phone: str, pending: dict):
+    _record("put", "pending_rts", phone, pending)
+
+def pop_pending(phone: str):
+    _record("pop", "pending_rts", phone)
+
+def _append_segment(ticket_id: int, lines: list):
+    started = time.perf_counter()
+    written = _segments.extend(str(ticket_id), lines)
+    metrics.DB_WRITE_SECONDS.observe(time.perf_counter() - started, "segments")
+    metrics.DB_WRITE_BYTES.inc("segments", amount=written)
+
+def append_transcript_line(ticket_id: int, line: transcript.Line):
+    if _segments:
+        _append_segment(ticket_id, [line])
+        return
+    _record("append", "transcripts", str(ticket_id), line)
+
+def append_transcript_lines(ticket_id: int, lines: list[transcript.Line]):
+    """
+    Append several lines as one change (one journal record / one snapshot).
+    """
+    if not lines:
+        return
+    if _segments:
+        _append_segment(ticket_id, list(lines))
+        return
+    _record("extend", "transcripts", str(ticket_id), list(lines))
+
+def drop_transcript(ticket_id: int):
+    with transaction():
+        if _segments:
+            _segments.drop(str(ticket_id))
+        else:
+            _record("pop", "transcripts", str(ticket_id))
+        _record("pop", "push_cursors", str(ticket_id))
+
+def claim_message(key: str, ttl: float, max_entries: int) -> bool:
+    """
+    Remember a webhook message id. False if it was already seen within `ttl`
+    seconds, i.e. the delivery is a duplicate. At most `max_entries` ids are
+    kept, oldest dropped first.
+    """
+    if _dedup:
+        return _dedup.claim(key, ttl, max_entries)
+    now = time.time()
+    with transaction():
+        _sql.delete_older_than("seen_messages", "ts", now - ttl)
+        if _sql.get("seen_messages", key):
+            return False
+        _sql.record("put", "seen_messages", key, {"ts": now})
+        _sql.trim("seen_messages", "ts", max_entries)
+        return True
+
+def release_message(key: str):
+    """
+    Forget a claimed id, so a redelivery is processed after all.
+    """
+    if _dedup:
+        _dedup.release(key)
+        return
+    _record("pop", "seen_messages", key)
+
+def get_outbox(key: str) -> dict | None:
+    return _get("outbox", key)
+
+def outbox() -> dict:
+    if _sql:
+        return _sql.items("outbox")
+    with _lock:
+        return {key: dict(entry) for key, entry in state.get("outbox", {}).items()}
+
+def put_outbox(key: str, entry: dict):
+    _record("put", "outbox", key, entry)
+
+def pop_outbox(key: str):
+    _record("pop", "outbox", key)
+
+def _outbox_heads(entries: dict) -> list[tuple[str, dict]]:
+    """
+    Entries that may be attempted: those without an order key and the
+    oldest of each order key. The rest wait, untouched, until they are head.
+    """
+    heads, out = {}, []
+    for key, entry in entries.items():
+        order = entry.get("order")
+        if order is None:
+            out.append((key, entry))
+        elif order not in heads or entry["created"] < heads[order][1]["created"]:
+            heads[order] = (key, entry)
+    return out + list(heads.values())
+
+def next_outbox_at() -> float | None:
+    if _sql:
+        return _sql.outbox_next_at()
+    with _lock:
+        return min((e["next_at"] for _, e in _outbox_heads(state.get("outbox", {}))), default=None)
+
+def claim_due_outbox(now: float, lease: float, limit: int) -> list[tuple[str, dict]]:
+    """
+    Up to `limit` outbox entries due by `now` that are at the head of their
+    order key, oldest first. Their next_at is pushed `lease` seconds out, so
+    another worker doesn't pick them up too.
+    """
+    with transaction():
+        if _sql:
+            due = _sql.outbox_due(now, limit)
+        else:
+            due = [(k, dict(e)) for k, e in _outbox_heads(state.get("outbox", {})) if e["next_at"] < now]
+            due = sorted(due, key=lambda kv: kv[1]["created"])[:limit]
+        for key, entry in due:
+            _record("put", "outbox", key, dict(entry, next_at=now + lease))
+    return due
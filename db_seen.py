@@ -0,0 +1,91 @@
+"""
+Webhook message-id dedup cache for db.py (file modes).
+
+The ids are kept in memory, oldest first, and on disk in their own
+append-only file (`+` a claim, `-` a release, one JSON line each) instead of
+in `state`, so claiming an id is one short append and never a snapshot.
+Expired and over-cap ids are dropped in memory only; the file is rewritten on
+load and whenever it holds twice as many lines as there are live ids.
+"""
+import json, os, threading, time
+import metrics
+
+_path  = None
+_fh    = None
+_lines = 0
+_seen  = {}   # id -> claimed at, in claim order
+_lock  = threading.Lock()
+
+
+def init(path: str, seed: dict | None = None):
+    """
+    Open the file at `path` and load it. `seed` ({id: {"ts"}} from an older
+    state file) is imported when the file doesn't exist yet.
+    """
+    global _path
+    _path = path
+    if not os.path.exists(path):
+        for key, entry in sorted((seed or {}).items(), key=lambda kv: kv[1]["ts"]):
+            _seen[key] = entry["ts"]
+    else:
+        with open(path) as f:
+            for line in f:
+                try:
+                    op, key, *ts = json.loads(line)
+                except ValueError:
+                    break   # torn last line
+                _seen.pop(key, None)
+                if op == "+":
+                    _seen[key] = ts[0]
+    # start from a compact file (this also drops a torn last line)
+    _rewrite()
+
+def _rewrite():
+    global _fh, _lines
+    if _fh:
+        _fh.close()
+    os.makedirs(os.path.dirname(_path) or ".", exist_ok=True)
+    tmp = _path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write("".join(json.dumps(["+", k, ts]) + "\n" for k, ts in _seen.items()))
+    os.replace(tmp, _path)
+    _lines = len(_seen)
+    _fh = open(_path, "a")
+
+def _write(rec: list):
+    global _lines
+    started = time.perf_counter()
+    data = json.dumps(rec) + "\n"
+    _fh.write(data)
+    _fh.flush()
+    _lines += 1
+    metrics.DB_WRITE_SECONDS.observe(time.perf_counter() - started, "seen")
+    metrics.DB_WRITE_BYTES.inc("seen", amount=len(data))
+    if _lines > 2 * len(_seen) + 1000:
+        _rewrite()
+
+def claim(key: str, ttl: float, max_entries: int) -> bool:
+    now = time.time()
+    with _lock:
+        if len(_seen) >= max_entries:
+            # make room for a tenth of the cap at once, not one id per claim
+            for old in list(_seen)[:len(_seen) - int(max_entries * 0.9)]:
+                del _seen[old]
+        while _seen:
+            old = next(iter(_seen))
+            if _seen[old] >= now - ttl:
+                break
+            del _seen[old]
+        if key in _seen:
+            return False
+        _seen[key] = now
+        _write(["+", key, now])
+        return True
+
+def release(key: str):
+    with _lock:
+        if _seen.pop(key, None) is not None:
+            _write(["-", key])
+
+def size() -> int:
+    return len(_seen)
@@ -0,0 +1,140 @@
+"""
+Transcript segment files for db.py (BRIDGE_TRANSCRIPT_STORE=segments).
+
+Instead of keeping every transcript in `state`, each ticket gets a directory
+of segment files, `<dir>/<ticket>/000000.jsonl`, `000001.jsonl`, ... with one
+line per item. All segments but the last hold exactly SEGMENT_LINES items;
+when the last one fills up it is sealed (gzip-compressed to `.jsonl.gz` with
+BRIDGE_TRANSCRIPT_COMPRESS) and a new one is started. Nothing is read until a
+ticket is rendered or appended to, and then only the segments needed; the
+only thing kept in memory is a line count per ticket touched so far.
+"""
+import gzip, json, os, shutil, threading
+from urllib.parse import quote, unquote
+
+SEGMENT_LINES = int(os.getenv("BRIDGE_TRANSCRIPT_SEGMENT_LINES", "500"))
+COMPRESS      = os.getenv("BRIDGE_TRANSCRIPT_COMPRESS", "1").lower() not in ("0", "false", "no")
+
+_dir    = None
+_lock   = threading.Lock()
+_counts = {}   # ticket -> number of lines, filled in lazily
+
+
+def init(path: str):
+    global _dir
+    _dir = path
+    os.makedirs(path, exist_ok=True)
+
+def _ticket_dir(ticket: str) -> str:
+    return os.path.join(_dir, quote(ticket, safe=""))
+
+def _segments(ticket: str) -> list[tuple[int, str]]:
+    """
+    (number, path) of every segment of `ticket`, in order. A plain segment
+    left next to its sealed copy (crash while sealing) is removed.
+    """
+    folder = _ticket_dir(ticket)
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return []
+    found = {}
+    for name in names:
+        stem, _, ext = name.partition(".")
+        if not stem.isdigit() or ext not in ("jsonl", "jsonl.gz"):
+            continue   # leftover .tmp
+        n = int(stem)
+        if n in found and ext == "jsonl":
+            os.remove(os.path.join(folder, name))
+            continue
+        if n in found:
+            os.remove(found[n])
+        found[n] = os.path.join(folder, name)
+    return sorted(found.items())
+
+def _read(path: str) -> list:
+    items = []
+    with (gzip.open(path, "rt") if path.endswith(".gz") else open(path)) as f:
+        for line in f:
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                break   # torn last line
+    return items
+
+def _truncate_torn(path: str):
+    # cut a torn last line off before appending after it
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+def _count(ticket: str) -> int:
+    if ticket not in _counts:
+        segments = _segments(ticket)
+        if segments and not segments[-1][1].endswith(".gz"):
+            _truncate_torn(segments[-1][1])
+        _counts[ticket] = (SEGMENT_LINES * (len(segments) - 1) + len(_read(segments[-1][1]))
+                           if segments else 0)
+    return _counts[ticket]
+
+def _seal(path: str):
+    if not COMPRESS:
+        return
+    tmp = path + ".gz.tmp"
+    with open(path, "rb") as src, gzip.open(tmp, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(tmp, path + ".gz")
+    os.remove(path)
+
+def tickets() -> list[str]:
+    return [unquote(name) for name in os.listdir(_dir)]
+
+def extend(ticket: str, items: list) -> int:
+    """
+    Append `items` to the ticket's transcript. Returns bytes written.
+    """
+    written = 0
+    with _lock:
+        count = _count(ticket)
+        os.makedirs(_ticket_dir(ticket), exist_ok=True)
+        while items:
+            n, used = divmod(count, SEGMENT_LINES)
+            chunk, items = items[:SEGMENT_LINES - used], items[SEGMENT_LINES - used:]
+            path = os.path.join(_ticket_dir(ticket), f"{n:06d}.jsonl")
+            data = "".join(json.dumps(item) + "\n" for item in chunk)
+            with open(path, "a") as f:
+                f.write(data)
+            written += len(data)
+            count += len(chunk)
+            _counts[ticket] = count
+            if used + len(chunk) == SEGMENT_LINES:
+                _seal(path)
+    return written
+
+def read(ticket: str, start: int = 0) -> list:
+    """
+    Items from index `start` on; segments before `start` are not read.
+    """
+    with _lock:
+        out = []
+        for n, path in _segments(ticket):
+            if (n + 1) * SEGMENT_LINES <= start:
+                continue
+            items = _read(path)
+            out.extend(items[max(start - n * SEGMENT_LINES, 0):])
+        return out
+
+def drop(ticket: str):
+    with _lock:
+        shutil.rmtree(_ticket_dir(ticket), ignore_errors=True)
+        _counts.pop(ticket, None)
+
+def sizes() -> dict:
+    """
+    Tickets on disk and lines over all of them. The first call reads the last
+    segment of every ticket, later ones use the cached counts.
+    """
+    with _lock:
+        names = tickets()
+        return {"transcripts": len(names), "transcript_lines": sum(_count(t) for t in names)}
@@ -0,0 +1,100 @@
+"""
+Per-key shard files for db.py (BRIDGE_DB_MODE=shards).
+
+State is kept in memory as in the other file modes, but on disk every entry
+has its own file: `<dir>/<collection>/<key>.json` for keyed entries and
+`<dir>/<collection>/<key>.jsonl` (one line per item) for list collections.
+db.py tracks which entries changed since the last flush and only those files
+are touched; a transcript line is one appended line, not a re-encode of the
+whole state.
+"""
+import json, os
+from urllib.parse import quote, unquote
+
+# collections whose values are lists, stored one item per line
+LISTS = ("transcripts",)
+SEEDED = ".seeded"
+
+_dir = None
+
+def _path(coll: str, key: str) -> str:
+    return os.path.join(_dir, coll, quote(key, safe="") + (".jsonl" if coll in LISTS else ".json"))
+
+def _replace(path: str, data: str) -> int:
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return len(data)
+
+def init(path: str, collections: tuple, seed=None) -> dict:
+    """
+    Open the shard directory at `path` and return the state it holds. On the
+    first start `seed()` (the JSON snapshot + journal) is written out once.
+    """
+    global _dir
+    _dir = path
+    for coll in collections:
+        os.makedirs(os.path.join(path, coll), exist_ok=True)
+    marker = os.path.join(path, SEEDED)
+    if not os.path.exists(marker) and seed is not None:
+        state = seed()
+        for coll in collections:
+            for key, value in state.get(coll, {}).items():
+                write(coll, key, value)
+        with open(marker, "w") as f:
+            f.write("1")
+        if any(state.get(coll) for coll in collections):
+            print("Imported JSON state into shard files:", {c: len(state.get(c, {})) for c in collections})
+        return {coll: dict(state.get(coll, {})) for coll in collections}
+    return load(collections)
+
+def load(collections: tuple) -> dict:
+    state = {}
+    for coll in collections:
+        entries = state[coll] = {}
+        folder = os.path.join(_dir, coll)
+        for name in os.listdir(folder):
+            stem, ext = os.path.splitext(name)
+            if ext not in (".json", ".jsonl"):
+                continue   # leftover .tmp from a crash mid-write
+            with open(os.path.join(folder, name)) as f:
+                if ext == ".json":
+                    try:
+                        entries[unquote(stem)] = json.load(f)
+                    except ValueError:
+                        print("Skipping unreadable shard", name)
+                    continue
+                items, torn = [], False
+                for line in f:
+                    try:
+                        items.append(json.loads(line))
+                    except ValueError:
+                        torn = True   # torn last line
+                        break
+            entries[unquote(stem)] = items
+            if torn:
+                # drop it, or the next appended line would be glued onto it
+                _replace(os.path.join(folder, name), "".join(json.dumps(v) + "\n" for v in items))
+    return state
+
+def write(coll: str, key: str, value, appended: int | None = None) -> int:
+    """
+    Persist one entry: delete its file when `value` is None, append the last
+    `appended` items of a list, otherwise rewrite the file. Returns bytes written.
+    """
+    path = _path(coll, key)
+    if value is None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return 0
+    if coll not in LISTS:
+        return _replace(path, json.dumps(value))
+    if appended is not None:
+        data = "".join(json.dumps(v) + "\n" for v in value[len(value) - appended:])
+        with open(path, "a") as f:
+            f.write(data)
+        return len(data)
+    return _replace(path, "".join(json.dumps(v) + "\n" for v in value))
@@ -0,0 +1,238 @@
+"""
+SQLite backend for db.py (BRIDGE_DB_MODE=sqlite).
+
+Every gunicorn worker and thread opens its own connection to the same WAL-mode
+database, so state is shared across processes instead of living in one
+process-local dict. Each mutation is its own transaction unless wrapped in
+`transaction()`.
+"""
+import json, os, sqlite3, threading
+from contextlib import contextmanager
+
+# keyed collections: table -> key column
+KEYED = {
+    "phone_to_chat": "phone",
+    "pending_rts": "phone",
+    "push_cursors": "ticket",
+    "seen_messages": "message",
+    "outbox": "id",
+}
+# columns copied out of `data` so they can be indexed: table -> {column: type}
+INDEXED = {
+    "phone_to_chat": {"last_customer_ts": "REAL"},
+    "seen_messages": {"ts": "REAL"},
+    "outbox": {"next_at": "REAL", "order": "TEXT", "created": "REAL"},
+}
+# append-only list collections: table -> key column
+LISTS = {
+    "transcripts": "ticket",
+}
+
+_path  = None
+_local = threading.local()
+
+def _schema() -> str:
+    ddl = ["CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"]
+    for table, col in KEYED.items():
+        ddl.append(f"CREATE TABLE IF NOT EXISTS {table} ({col} TEXT PRIMARY KEY, data TEXT NOT NULL)")
+    for table, col in LISTS.items():
+        ddl.append(
+            f"CREATE TABLE IF NOT EXISTS {table} "
+            f"(seq INTEGER PRIMARY KEY AUTOINCREMENT, {col} TEXT NOT NULL, data TEXT NOT NULL)"
+        )
+        ddl.append(f"CREATE INDEX IF NOT EXISTS {table}_{col} ON {table} ({col}, seq)")
+    return ";\n".join(ddl) + ";"
+
+def _conn() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        # isolation_level=None: we issue BEGIN/COMMIT ourselves
+        conn = sqlite3.connect(_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        _local.conn = conn
+        _local.depth = 0
+    return conn
+
+@contextmanager
+def transaction():
+    """
+    Group several mutations into one write transaction. Nested calls join the
+    outer transaction.
+    """
+    conn = _conn()
+    if _local.depth:
+        _local.depth += 1
+        try:
+            yield conn
+        finally:
+            _local.depth -= 1
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    _local.depth = 1
+    try:
+        yield conn
+    except BaseException:
+        _local.depth = 0
+        conn.execute("ROLLBACK")
+        raise
+    _local.depth = 0
+    conn.execute("COMMIT")
+
+def _add_indexed_columns():
+    """
+    Add (and backfill) INDEXED columns, also on databases created before
+    they existed.
+    """
+    with transaction() as conn:
+        for table, cols in INDEXED.items():
+            have = {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+            for col, typ in cols.items():
+                if col not in have:
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN "{col}" {typ}')
+                    conn.execute(f'UPDATE {table} SET "{col}" = json_extract(data, \'$.{col}\')')
+                conn.execute(f'CREATE INDEX IF NOT EXISTS {table}_{col} ON {table} ("{col}")')
+
+def _put_sql(table: str) -> str:
+    cols = [KEYED[table], "data", *(f'"{col}"' for col in INDEXED.get(table, {}))]
+    return f"INSERT OR REPLACE INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})"
+
+def _put_row(table: str, key: str, value) -> tuple:
+    extra = [(value or {}).get(col) for col in INDEXED.get(table, {})]
+    return (key, json.dumps(value), *extra)
+
+def init(path: str, seed=None):
+    """
+    Open the database at `path` and create the schema. If the database has
+    never been seeded and `seed` is given, `seed()` must return a state dict
+    (as loaded from bridge_state.json) which is imported once.
+    """
+    global _path
+    _path = path
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    _conn().executescript(_schema())
+    _add_indexed_columns()
+    if seed is None:
+        return
+    with transaction() as conn:
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'seeded'").fetchone():
+            return
+        imported = import_state(seed())
+        conn.execute("INSERT INTO meta (key, value) VALUES ('seeded', ?)", (json.dumps(imported),))
+    if any(imported.values()):
+        print("Imported JSON state into SQLite:", imported)
+
+def import_state(s: dict) -> dict:
+    """
+    Copy a JSON-style state dict into the tables, return row counts.
+    """
+    counts = {}
+    with transaction() as conn:
+        for table, col in KEYED.items():
+            rows = [_put_row(table, k, v) for k, v in s.get(table, {}).items()]
+            conn.executemany(_put_sql(table), rows)
+            counts[table] = len(rows)
+        for table, col in LISTS.items():
+            rows = [(k, json.dumps(v)) for k, items in s.get(table, {}).items() for v in items]
+            conn.executemany(f"INSERT INTO {table} ({col}, data) VALUES (?, ?)", rows)
+            counts[table] = len(rows)
+    return counts
+
+def get(coll: str, key: str):
+    conn = _conn()
+    if coll in LISTS:
+        return get_list(coll, key)
+    row = conn.execute(f"SELECT data FROM {coll} WHERE {KEYED[coll]} = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def get_list(coll: str, key: str, start: int = 0) -> list:
+    rows = _conn().execute(
+        f"SELECT data FROM {coll} WHERE {LISTS[coll]} = ? ORDER BY seq LIMIT -1 OFFSET ?", (key, start)
+    ).fetchall()
+    return [json.loads(r[0]) for r in rows]
+
+def items(coll: str) -> dict:
+    conn = _conn()
+    if coll in LISTS:
+        out = {}
+        for key, data in conn.execute(f"SELECT {LISTS[coll]}, data FROM {coll} ORDER BY seq"):
+            out.setdefault(key, []).append(json.loads(data))
+        return out
+    return {k: json.loads(d) for k, d in conn.execute(f"SELECT {KEYED[coll]}, data FROM {coll}")}
+
+def record(op: str, coll: str, key: str, value=None):
+    with transaction() as conn:
+        if op == "put":
+            conn.execute(_put_sql(coll), _put_row(coll, key, value))
+        elif op == "pop":
+            col = KEYED.get(coll) or LISTS[coll]
+            conn.execute(f"DELETE FROM {coll} WHERE {col} = ?", (key,))
+        elif op == "append":
+            conn.execute(f"INSERT INTO {coll} ({LISTS[coll]}, data) VALUES (?, ?)", (key, json.dumps(value)))
+        elif op == "extend":
+            conn.executemany(f"INSERT INTO {coll} ({LISTS[coll]}, data) VALUES (?, ?)",
+                             [(key, json.dumps(v)) for v in value])
+
+def min_value(coll: str, column: str):
+    row = _conn().execute(f"SELECT MIN({column}) FROM {coll}").fetchone()
+    return row[0] if row else None
+
+def older_than(coll: str, column: str, before: float) -> list[tuple[str, dict]]:
+    rows = _conn().execute(
+        f"SELECT {KEYED[coll]}, data FROM {coll} WHERE {column} < ? ORDER BY {column}", (before,)
+    ).fetchall()
+    return [(k, json.loads(d)) for k, d in rows]
+
+# outbox entries that may be attempted: no order key, or the oldest of theirs
+_OUTBOX_HEAD = ('("order" IS NULL OR created = '
+                '(SELECT MIN(created) FROM outbox AS o WHERE o."order" = outbox."order"))')
+
+def outbox_next_at() -> float | None:
+    row = _conn().execute(f"SELECT next_at FROM outbox WHERE {_OUTBOX_HEAD} ORDER BY next_at LIMIT 1").fetchone()
+    return row[0] if row else None
+
+def outbox_due(before: float, limit: int) -> list[tuple[str, dict]]:
+    """
+    Up to `limit` outbox heads with next_at before `before`, oldest first.
+    """
+    rows = _conn().execute(
+        f"SELECT id, data FROM outbox WHERE next_at < ? AND {_OUTBOX_HEAD} ORDER BY created LIMIT ?",
+        (before, limit)
+    ).fetchall()
+    return [(k, json.loads(d)) for k, d in rows]
+
+def delete_older_than(coll: str, column: str, before: float) -> int:
+    with transaction() as conn:
+        return conn.execute(f"DELETE FROM {coll} WHERE {column} < ?", (before,)).rowcount
+
+def trim(coll: str, column: str, keep: int) -> int:
+    """
+    Delete all but the `keep` rows with the highest `column`.
+    """
+    col = KEYED[coll]
+    with transaction() as conn:
+        return conn.execute(
+            f"DELETE FROM {coll} WHERE {col} NOT IN "
+            f"(SELECT {col} FROM {coll} ORDER BY {column} DESC LIMIT ?)", (keep,)
+        ).rowcount
+
+def sizes() -> dict:
+    conn = _conn()
+    out = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in KEYED}
+    for table, col in LISTS.items():
+        out[table] = conn.execute(f"SELECT COUNT(DISTINCT {col}) FROM {table}").fetchone()[0]
+    out["transcript_lines"] = conn.execute("SELECT COUNT(*) FROM transcripts").fetchone()[0]
+    return out
+
+def checkpoint():
+    _conn().execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+if __name__ == "__main__":
+    # one-off migration: python db_sqlite.py <bridge_state.json> <bridge_state.sqlite3>
+    # (the bridge also does this on its first start with BRIDGE_DB_MODE=sqlite)
+    import sys
+    src, dst = sys.argv[1], sys.argv[2]
+    with open(src) as f:
+        raw = json.load(f)
+    init(dst, seed=lambda: raw)
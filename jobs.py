@@ -0,0 +1,179 @@
+"""
+In-process job queue for webhook work.
+
+Jobs are sharded onto worker threads by key (the customer phone), so jobs for
+one chat run one at a time in submission order while different chats run in
+parallel.
+
+Admission is bounded three ways, so a slow upstream makes the bridge refuse
+new webhooks quickly (the sender retries them later) instead of letting work
+pile up: a cap on queued jobs (`maxsize`), on queued jobs per key
+(`max_per_key`, one chat flooding the queue) and on how long the job at the
+head of a worker's queue has been waiting (`max_wait`, i.e. the worker is
+stuck behind a slow call).
+"""
+import queue, threading, time, zlib
+import metrics
+
+
+class QueueFull(Exception):
+    reason = "queue_full"
+
+
+class KeyBusy(QueueFull):
+    reason = "key_busy"
+
+
+class QueueLagging(QueueFull):
+    reason = "queue_lag"
+
+
+class JobQueue:
+    def __init__(self, workers: int = 4, maxsize: int = 1000, name: str = "jobs",
+                 max_per_key: int = 0, max_wait: float = 0):
+        self.name = name
+        self.maxsize = maxsize
+        self.max_per_key = max_per_key   # 0: no limit
+        self.max_wait = max_wait         # seconds, 0: no limit
+        self._queues = [queue.Queue() for _ in range(max(1, workers))]
+        # per worker: when the job it is running was queued (None while idle);
+        # the queues are FIFO so that is the oldest job of the shard
+        self._running_since = [None] * len(self._queues)
+        self._per_key = {}
+        self._threads = []
+        self._closed = False
+        self._stats_lock = threading.Lock()
+        self._pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.run_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(len(self._queues)):
+            t = threading.Thread(target=self._worker, args=(i,), name=f"{self.name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        print(f"Job queue started ({len(self._queues)} workers, max {self.maxsize} queued)")
+
+    def submit(self, key: str, fn, *args, **kwargs):
+        """
+        Queue `fn(*args, **kwargs)` behind earlier jobs with the same key.
+        Raises QueueFull when `maxsize` jobs are already waiting.
+        """
+        self.submit_all([(key, fn, args, kwargs)])
+
+    def submit_all(self, batch: list[tuple]):
+        """
+        Queue several (key, fn, args, kwargs) jobs, all or none: raises
+        QueueFull (or KeyBusy / QueueLagging) without queueing anything if
+        they don't all fit.
+        """
+        now = time.monotonic()
+        adding = {}
+        for key, *_ in batch:
+            adding[key] = adding.get(key, 0) + 1
+        with self._stats_lock:
+            try:
+                if self._closed:
+                    raise QueueFull(f"{self.name}: shutting down")
+                if self._pending + len(batch) > self.maxsize:
+                    raise QueueFull(f"{self.name}: {self._pending} jobs queued")
+                for key, n in adding.items():
+                    if self.max_per_key and self._per_key.get(key, 0) + n > self.max_per_key:
+                        raise KeyBusy(f"{self.name}: {self._per_key.get(key, 0)} jobs queued for {key}")
+                    since = self._running_since[self._shard(key)]
+                    if self.max_wait and since is not None and now - since > self.max_wait:
+                        raise QueueLagging(f"{self.name}: worker for {key} busy for {now - since:.1f}s")
+            except QueueFull as e:
+                metrics.JOBS_REJECTED.inc(e.reason)
+                raise
+            self._pending += len(batch)
+            self.submitted += len(batch)
+            for key, n in adding.items():
+                self._per_key[key] = self._per_key.get(key, 0) + n
+        for key, fn, args, kwargs in batch:
+            self._queues[self._shard(key)].put((now, key, fn, args, kwargs))
+
+    def _shard(self, key) -> int:
+        return zlib.crc32(str(key).encode()) % len(self._queues)
+
+    def _worker(self, i: int):
+        q = self._queues[i]
+        while True:
+            enqueued, key, fn, args, kwargs = q.get()
+            self._running_since[i] = enqueued
+            started = time.monotonic()
+            ok = True
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                ok = False
+                print(f"Job {getattr(fn, '__name__', fn)} for {key} failed:", repr(e))
+            finished = time.monotonic()
+            name = getattr(fn, "__name__", "job")
+            metrics.JOB_WAIT_SECONDS.observe(started - enqueued, name)
+            metrics.JOB_SECONDS.observe(finished - started, name)
+            with self._stats_lock:
+                self._running_since[i] = None
+                self._pending -= 1
+                left = self._per_key.get(key, 0) - 1
+                if left > 0:
+                    self._per_key[key] = left
+                else:
+                    self._per_key.pop(key, None)
+                self.completed += ok
+                self.failed += not ok
+                self.wait_total += started - enqueued
+                self.run_total += finished - started
+                self.latency_max = max(self.latency_max, finished - enqueued)
+            q.task_done()
+
+    def depth(self) -> int:
+        return self._pending
+
+    def join(self, timeout: float | None = None) -> bool:
+        """
+        Wait until every queued job has run, return False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._pending:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stop(self, timeout: float = 10.0):
+        """
+        Refuse new jobs and give queued ones up to `timeout` to finish.
+        """
+        self._closed = True
+        if not self.join(timeout):
+            print(f"{self.name}: {self._pending} jobs still queued at shutdown")
+
+    def lag(self) -> float:
+        """
+        Seconds the longest-running job has been queued + running.
+        """
+        now = time.monotonic()
+        return max((now - t for t in self._running_since if t is not None), default=0.0)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            done = self.completed + self.failed
+            return {
+                "workers": len(self._queues),
+                "depth": self._pending,
+                "shard_depths": [q.qsize() for q in self._queues],
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "avg_wait_ms": round(1000 * self.wait_total / done, 2) if done else 0.0,
+                "avg_run_ms": round(1000 * self.run_total / done, 2) if done else 0.0,
+                "max_latency_ms": round(1000 * self.latency_max, 2),
+                "lag_seconds": round(self.lag(), 3),
+            }
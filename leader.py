@@ -0,0 +1,111 @@
+"""
+Lease so only one worker process runs the cleanup loop.
+
+The lease is a small JSON file on the data volume ({"owner", "expires"}) that
+every worker tries to take from a heartbeat thread; the holder renews it
+every `ttl / 3` seconds.
+Reads and writes of the file happen under an flock on `<path>.lock`, so two
+workers can't both see it free. A lease whose owner is a dead process on the
+same host is taken over straight away; otherwise it is free once `expires`
+has passed (owner hung, or on another host).
+"""
+import fcntl, json, os, socket, threading, time, uuid
+from contextlib import contextmanager
+
+
+class Lease:
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._expires = 0.0   # our copy of the lease expiry while we hold it
+
+    @property
+    def held(self) -> bool:
+        # a holder that stopped renewing (e.g. was paused) stops acting as
+        # leader when its lease runs out, i.e. before anyone else can take it
+        return time.time() < self._expires
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".lock", "a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, data: dict):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def _owner_dead(owner: str) -> bool:
+        host, pid, _ = (owner.split(":") + ["", "", ""])[:3]
+        if host != socket.gethostname() or not pid.isdigit():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    def acquire(self) -> bool:
+        """
+        Take or renew the lease. True while this process holds it.
+        """
+        now = time.time()
+        with self._locked():
+            current = self._read()
+            owner = current.get("owner")
+            free = (not owner or owner == self.owner or current.get("expires", 0) < now
+                    or self._owner_dead(owner))
+            if free:
+                self._write({"owner": self.owner, "expires": now + self.ttl})
+                if owner != self.owner:
+                    print(f"Took the cleanup lease ({self.path})" + (f" from {owner}" if owner else ""))
+                self._expires = now + self.ttl
+            else:
+                if self._expires:
+                    print(f"Lost the cleanup lease to {owner}")
+                self._expires = 0.0
+        return self.held
+
+    def release(self):
+        if not self.held:
+            return
+        with self._locked():
+            if self._read().get("owner") == self.owner:
+                os.remove(self.path)
+            self._expires = 0.0
+
+    def start(self, stop: threading.Event):
+        """
+        Heartbeat: take or renew the lease every `ttl / 3` seconds until `stop`
+        is set, then let it go.
+        """
+        def beat():
+            try:
+                self.acquire()
+            except OSError as e:
+                print("Cleanup lease error:", e)
+
+        def heartbeat():
+            while not stop.wait(self.ttl / 3):
+                beat()
+            self.release()
+
+        beat()
+        threading.Thread(target=heartbeat, name="cleanup-lease", daemon=True).start()
@@ -1,14 +1,15 @@
 from flask import Flask, request, jsonify, abort
-import os, re, requests, db, json, uuid
+import os, re, capture, db, jobs, leader, media, metrics, outbound, outbox, transcript, json
+from upstream import Upstream
 import textwrap
 import re
 import mimetypes
-import html
-from urllib.parse import urljoin
 import time
 import threading
-import atexit, signal
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import atexit, functools, signal
 import hmac, hashlib
+import requests
 
 app = Flask(__name__)
 
@@ -22,16 +23,129 @@ WEBHOOK_VERIFY_TOKEN  = os.environ["WEBHOOK_VERIFY_TOKEN"]
 BUSINESS_PHONE_NUMBER_ID = os.environ["BUSINESS_PHONE_NUMBER_ID"]
 APP_SECRET = os.environ["META_APP_SECRET"]  
 PORT                  = int(os.getenv("PORT", 5000))
+RT_BASE_URL           = os.environ["RT_BASE_URL"].rstrip("/")
+RT_TOKEN              = os.environ["RT_TOKEN"]
 
-ZULIP_API_URL = "https://chat-test.filmlight.ltd.uk/api/v1/messages"
-ZULIP_BASE_URL = ZULIP_API_URL.split('/api', 1)[0] 
+# upstream base URLs, overridable so the bridge can run against local stubs
+ZULIP_BASE_URL = os.getenv("ZULIP_BASE_URL", "https://chat-test.filmlight.ltd.uk").rstrip("/")
+ZULIP_API_URL  = f"{ZULIP_BASE_URL}/api/v1/messages"
+GRAPH_API_URL  = os.getenv("GRAPH_API_URL", "https://graph.facebook.com/v22.0").rstrip("/")
 MAX_CHATS     = 2                       # slot0 and slot1 only
 CLOSED_REPLY = "Chat closed, please contact support to start a new chat."
 CHAT_TTL_SECONDS = 60 * 60 * 20 # chats close after 20 hours on inactivity 
+INTAKE_CLAIM_SECONDS = 300 # a ticket creation taken this long ago is assumed lost
 CLEANUP_INTERVAL_SECONDS = int(os.getenv("CLEANUP_INTERVAL_SECONDS", "60"))
 CLEANUP_STOP = threading.Event()
 EXPIRY_LOCK = threading.Lock()
 _CLEANUP_STARTED = False
+# only the worker holding this lease sweeps / compacts (see leader.py)
+CLEANUP_LEASE_FILE    = os.getenv("CLEANUP_LEASE_FILE", os.path.splitext(db.DATA_FILE)[0] + ".cleanup-lease")
+CLEANUP_LEASE_SECONDS = float(os.getenv("CLEANUP_LEASE_SECONDS", "30"))
+CLEANUP_LEASE = None
+# webhook work runs on a job queue, sharded per phone so each chat stays in order
+JOB_WORKERS   = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "1000"))
+JOB_MAX_PER_PHONE   = int(os.getenv("JOB_MAX_PER_PHONE", "50"))
+JOB_MAX_WAIT_SECONDS = float(os.getenv("JOB_MAX_WAIT_SECONDS", "60"))
+JOBS = jobs.JobQueue(workers=JOB_WORKERS, maxsize=JOB_QUEUE_MAX,
+                     max_per_key=JOB_MAX_PER_PHONE, max_wait=JOB_MAX_WAIT_SECONDS)
+# webhook requests handled at once per process (0 = no limit); keep it below
+# GUNICORN_THREADS so /health and /metrics still get a thread
+WEBHOOK_MAX_INFLIGHT = int(os.getenv("WEBHOOK_MAX_INFLIGHT", "0"))
+_WEBHOOK_SLOTS = threading.BoundedSemaphore(WEBHOOK_MAX_INFLIGHT) if WEBHOOK_MAX_INFLIGHT else None
+# Retry-After sent with a shed webhook
+SHED_RETRY_AFTER = int(os.getenv("SHED_RETRY_AFTER", "30"))
+
+# consecutive customer texts arriving within this many seconds go to the
+# stream as one post (0 = off)
+COALESCE_WINDOW_SECONDS = float(os.getenv("COALESCE_WINDOW_SECONDS", "0"))
+_COALESCE = {}   # phone -> {"texts": [...], "ts": time of the last one, "timer": Timer}
+_COALESCE_LOCK = threading.Lock()
+# chat / intake state of one customer is only touched under that phone's lock;
+# phones share PHONE_LOCK_STRIPES locks, so different customers rarely wait on each other
+PHONE_LOCK_STRIPES = int(os.getenv("PHONE_LOCK_STRIPES", "64"))
+_PHONE_LOCKS = [threading.RLock() for _ in range(PHONE_LOCK_STRIPES)]
+
+def _phone_lock(phone: str) -> threading.RLock:
+    return _PHONE_LOCKS[hash(phone) % PHONE_LOCK_STRIPES]
+
+def _locks_phone(fn):
+    """
+    Run `fn(phone, ...)` holding the phone's lock.
+    """
+    @functools.wraps(fn)
+    def wrapper(phone, *args, **kwargs):
+        with _phone_lock(phone):
+            return fn(phone, *args, **kwargs)
+    return wrapper
+
+# webhook message ids already accepted, so redeliveries are dropped up front
+DEDUP_TTL_SECONDS = int(os.getenv("DEDUP_TTL_SECONDS", str(3 * 24 * 60 * 60)))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "10000"))
+
+# already-relayed media: WhatsApp sha256 -> Zulip uri, Zulip upload -> Graph media id
+MEDIA_CACHE = media.MediaCache(max_entries=int(os.getenv("MEDIA_CACHE_SIZE", "1000")))
+
+# opt-in webhook capture for bench/replay.py (see capture.py)
+CAPTURE_DIR       = os.getenv("CAPTURE_DIR", "")
+CAPTURE_MAX_BYTES = int(os.getenv("CAPTURE_MAX_BYTES", str(64 * 1024 * 1024)))
+CAPTURE_KEEP      = int(os.getenv("CAPTURE_KEEP", "10"))
+CAPTURE_MASK      = os.getenv("CAPTURE_MASK", "1").lower() not in ("0", "false", "no")
+CAPTURE_MASK_TEXT = os.getenv("CAPTURE_MASK_TEXT", "0").lower() not in ("0", "false", "no")
+CAPTURE = None
+if CAPTURE_DIR:
+    _masker = (capture.Masker(os.getenv("CAPTURE_MASK_KEY", APP_SECRET), text=CAPTURE_MASK_TEXT)
+               if CAPTURE_MASK else None)
+    CAPTURE = capture.Recorder(CAPTURE_DIR, CAPTURE_MAX_BYTES, CAPTURE_KEEP, _masker,
+                               meta={"bot_email": _masker.email(ZULIP_BOT_EMAIL) if _masker else ZULIP_BOT_EMAIL})
+_CAPTURED = {"receive_whatsapp": "whatsapp", "receive_zulip": "zulip"}
+
+# /metrics: request and cleanup timings, plus gauges read at scrape time
+HTTP_SECONDS = metrics.Histogram(
+    "bridge_http_request_seconds", "Time to answer an incoming request.", ("endpoint", "status"))
+CLEANUP_SECONDS = metrics.Histogram(
+    "bridge_cleanup_sweep_seconds", "Duration of one expired-chat sweep.")
+CHATS_EXPIRED = metrics.Counter("bridge_chats_expired_total", "Chats closed for inactivity.")
+WEBHOOKS_SHED = metrics.Counter(
+    "bridge_webhooks_shed_total", "Webhooks refused with a 503 / 429 by admission control.", ("endpoint", "reason"))
+_state_sizes = {}   # db.sizes(), refreshed once per scrape
+metrics.Gauge("bridge_open_chats", "Open chats.", lambda: _state_sizes.get("phone_to_chat", 0))
+metrics.Gauge("bridge_pending_intakes", "Customers part way through the intake questions.",
+              lambda: _state_sizes.get("pending_rts", 0))
+metrics.Gauge("bridge_transcripts", "Tickets with a stored transcript.",
+              lambda: _state_sizes.get("transcripts", 0))
+metrics.Gauge("bridge_transcript_lines", "Transcript lines over all tickets.",
+              lambda: _state_sizes.get("transcript_lines", 0))
+metrics.Gauge("bridge_outbox_pending", "Deliveries waiting in the outbox for a retry.",
+              lambda: _state_sizes.get("outbox", 0))
+metrics.Gauge("bridge_cleanup_leader", "1 if this worker holds the cleanup lease.",
+              lambda: int(bool(CLEANUP_LEASE and CLEANUP_LEASE.held)))
+metrics.Gauge("bridge_job_queue_depth", "Webhook jobs queued or running.", lambda: JOBS.depth())
+metrics.Gauge("bridge_job_queue_lag_seconds", "How long the oldest running job has been queued + running.",
+              lambda: round(JOBS.lag(), 3))
+
+# pooled keep-alive clients, one per upstream (timeouts in seconds)
+UPLOAD_TIMEOUT = int(os.getenv("UPLOAD_TIMEOUT", "60"))
+# seconds a call waits for a free concurrency slot before failing (and going to the outbox)
+UPSTREAM_SLOT_WAIT = float(os.getenv("UPSTREAM_SLOT_WAIT", "5"))
+GRAPH = Upstream("graph", timeout=int(os.getenv("GRAPH_TIMEOUT", "10")),
+                 headers={"Authorization": f"Bearer {GRAPH_API_TOKEN}"},
+                 max_concurrency=int(os.getenv("GRAPH_MAX_CONCURRENCY", "8")),
+                 slot_wait=UPSTREAM_SLOT_WAIT)
+ZULIP = Upstream("zulip", timeout=int(os.getenv("ZULIP_TIMEOUT", "10")),
+                 auth=(ZULIP_BOT_EMAIL, ZULIP_API_KEY),
+                 max_concurrency=int(os.getenv("ZULIP_MAX_CONCURRENCY", "8")),
+                 slot_wait=UPSTREAM_SLOT_WAIT)
+RT    = Upstream("rt", timeout=int(os.getenv("RT_TIMEOUT", "15")),
+                 headers={"Authorization": f"token {RT_TOKEN}"},
+                 max_concurrency=int(os.getenv("RT_MAX_CONCURRENCY", "4")),
+                 slot_wait=UPSTREAM_SLOT_WAIT)
+metrics.Gauge("bridge_upstream_inflight", "Outbound calls in flight per upstream.",
+              lambda: {(u.name,): u.inflight for u in (GRAPH, ZULIP, RT)}, ("upstream",))
+
+# expired chats are closed in parallel, each on its own pool thread
+EXPIRY_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("EXPIRY_WORKERS", "4")),
+                                 thread_name_prefix="expiry")
 # eng to email map
 ENGINEER_EMAIL_MAP = {
     k[len("ENGINEER_EMAIL_"):].lower(): v
@@ -44,8 +158,61 @@ INIT_RE  = re.compile(r"RT\s*#?(\d+)\s*\(([^)]+)\)", re.I)     # first WA text
 
 
 
-def _log_line(ticket_id: int, line: str):
-    db.append_transcript_line(ticket_id, line)
+def _log_line(ticket_id: int, direction: int, body: str, uri: str | None = None, mime: str | None = None):
+    db.append_transcript_line(ticket_id, transcript.Line(direction, round(time.time(), 3), body, uri, mime))
+
+def _forward_customer_text(phone: str, chat: dict, texts: list[str], ts: float):
+    """
+    Post customer texts to the chat's topic as one message and log them.
+    """
+    print("Customer to stream:", "\n".join(texts))
+    db.append_transcript_lines(chat["ticket"], [transcript.Line(transcript.TO_ENGINEER, round(ts, 3), t) for t in texts])
+    # update last customer activity
+    chat["last_customer_ts"] = ts
+    db.put_chat(phone, chat)
+    _post_to_stream(chat["topic"], "\n".join(texts))
+
+def _buffer_customer_text(phone: str, text: str):
+    with _COALESCE_LOCK:
+        buf = _COALESCE.get(phone)
+        if buf is None:
+            timer = threading.Timer(COALESCE_WINDOW_SECONDS, _schedule_flush, args=(phone,))
+            timer.daemon = True
+            buf = _COALESCE[phone] = {"texts": [], "ts": 0.0, "timer": timer}
+            timer.start()
+        buf["texts"].append(text)
+        buf["ts"] = time.time()
+
+def _schedule_flush(phone: str):
+    # through the job queue, so the flush stays in order with the chat's other jobs
+    try:
+        JOBS.submit(phone, _flush_customer_text, phone)
+    except jobs.QueueFull:
+        _flush_customer_text(phone)
+
+@_locks_phone
+def _flush_customer_text(phone: str, chat: dict | None = None):
+    """
+    Forward whatever customer text is buffered for `phone`. Called before
+    anything else is done for the chat, so the topic and the transcript
+    keep the order the messages arrived in.
+    """
+    with _COALESCE_LOCK:
+        buf = _COALESCE.pop(phone, None)
+    if not buf:
+        return
+    buf["timer"].cancel()
+    chat = chat or db.get_chat(phone)
+    if not chat:
+        print(f"Dropping {len(buf['texts'])} buffered messages from {phone}: chat is closed")
+        return
+    _forward_customer_text(phone, chat, buf["texts"], buf["ts"])
+
+def _flush_all_customer_text():
+    with _COALESCE_LOCK:
+        phones = list(_COALESCE)
+    for phone in phones:
+        _schedule_flush(phone)
 
 #create RT Ticket
 
@@ -53,18 +220,14 @@ def _create_rt_ticket(subject: str, requestor: str, description: str) -> int | N
     """
     Create a new RT ticket and return its ticket ID, or None on failure.
     """
-    rt_url = f"{os.environ['RT_BASE_URL'].rstrip('/')}/ticket"
-    headers = {
-        "Authorization": f"token {os.environ['RT_TOKEN']}",
-        "Content-Type": "application/json"
-    }
+    rt_url = f"{RT_BASE_URL}/ticket"
     data = {
         "Subject": subject,
         "Queue": "Test",
         "Requestor": requestor,
         "Text": description
     }
-    resp = requests.post(rt_url, headers=headers, json=data)
+    resp = RT.post(rt_url, op="rt_create", json=data)
     if resp.status_code == 201:
         ticket_id = resp.json().get("id")
         print(f"Created RT ticket {ticket_id}")
@@ -81,11 +244,10 @@ def _do_send_whatsapp(to: str, msg: str):
         "type": "text",
         "text": {"body": msg}
     }
-    resp = requests.post(
-       f"https://graph.facebook.com/v22.0/{BUSINESS_PHONE_NUMBER_ID}/messages",
-        json=payload,
-        headers={"Authorization": f"Bearer {GRAPH_API_TOKEN}"},
-        timeout=10
+    resp = GRAPH.post(
+       f"{GRAPH_API_URL}/{BUSINESS_PHONE_NUMBER_ID}/messages",
+        op="whatsapp_send",
+        json=payload
     )
     if not resp.ok:
         print("WhatsApp send failed:", resp.status_code, resp.text)
@@ -111,18 +273,128 @@ def _verify_meta_signature():
 
 def _send_zulip_dm_stream(stream: str, topic: str, content: str):
     print(f"Stream: {stream}, Topic: {topic}")
-    return requests.post(
+    return ZULIP.post(
         ZULIP_API_URL,
+        op="zulip_post",
         data={
             "type": "stream",
             "to": stream,
             "topic": topic,
             "content": content
-        },
-        auth = (ZULIP_BOT_EMAIL, ZULIP_API_KEY),
-        timeout = 10
+        }
+    )
+
+def _upload_zulip_file(file_name: str, mime_type: str, chunks, size: int | None = None):
+    content_type, body = media.multipart(file_name, mime_type, chunks, size)
+    return ZULIP.post(
+        f"{ZULIP_BASE_URL}/api/v1/user_uploads",
+        op="zulip_upload",
+        data=body,
+        headers={"Content-Type": content_type},
+        timeout=UPLOAD_TIMEOUT
+    )
+
+def _upload_whatsapp_media(file_name: str, mime_type: str, chunks, size: int | None = None):
+    content_type, body = media.multipart(
+        file_name, mime_type, chunks, size,
+        fields={"messaging_product": "whatsapp", "type": mime_type}
     )
+    return GRAPH.post(
+        f"{GRAPH_API_URL}/{BUSINESS_PHONE_NUMBER_ID}/media",
+        op="whatsapp_upload",
+        data=body,
+        headers={"Content-Type": content_type},
+        timeout=UPLOAD_TIMEOUT
+    )
+
+def _media_info(media_id: str) -> dict | None:
+    resp = GRAPH.get(f"{GRAPH_API_URL}/{media_id}", op="media_info")
+    return resp.json() if _accepted(resp, "WhatsApp media lookup") else None
 
+def _relay_whatsapp_media(media_id: str, upload_name: str, mime_type: str, sha256: str | None = None) -> str | None:
+    """
+    Copy a WhatsApp media object to Zulip user_uploads and return its uri, or
+    None when Graph or Zulip turned it down for good (other failures raise).
+    Content relayed before (same sha256) is neither downloaded nor uploaded again.
+    """
+    info = None
+    if not sha256:
+        info = _media_info(media_id)
+        if info is None:
+            return None
+        sha256 = info.get("sha256")
+    key = f"wa:{sha256}" if sha256 else None
+    if key and (cached := MEDIA_CACHE.get(key)):
+        return cached
+
+    if info is None:
+        info = _media_info(media_id)
+        if info is None:
+            return None
+    with GRAPH.get(info.get("url"), op="media_fetch", stream=True) as src:
+        if not _accepted(src, "WhatsApp media download"):
+            return None
+        chunks = media.Tap(media.iter_body(src))
+        zulip_upload = _upload_zulip_file(upload_name, mime_type, chunks, media.content_length(src))
+    if not _accepted(zulip_upload, "Zulip upload"):
+        return None
+    upload_uri = zulip_upload.json().get("uri")
+    if not upload_uri:
+        print("Zulip upload returned no uri:", zulip_upload.text)
+        return None
+    if key:
+        MEDIA_CACHE.put(key, upload_uri, chunks.size)
+    return upload_uri
+
+def _relay_zulip_file(relative_url: str, file_name: str) -> dict | None:
+    """
+    Copy a Zulip upload to Graph /media. Returns {"id", "mime", "name"} (name and
+    mime may change on the text/plain retry), or None when Zulip or Graph turned
+    it down for good (other failures raise). A Zulip upload relayed before is not
+    downloaded or uploaded again while its media id is valid.
+    """
+    key = f"zulip:{relative_url}"
+    if cached := MEDIA_CACHE.get(key):
+        return cached
+
+    zulip_file_url = f"{ZULIP_BASE_URL}{relative_url}"
+
+    # Stream the file from Zulip straight into the Graph upload
+    src = ZULIP.get(zulip_file_url, op="zulip_fetch", stream=True)
+
+    if not src.ok:
+        with src:
+            _accepted(src, "Zulip download")   # raises unless rejected for good
+        return None
+
+    mime_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+
+    with src:
+        if mime_type in media.WHATSAPP_MEDIA_TYPES:
+            chunks = media.Tap(media.iter_body(src))
+            media_upload = _upload_whatsapp_media(file_name, mime_type, chunks, media.content_length(src))
+            size = chunks.size
+        else:
+            # Graph will most likely reject this type and we retry as
+            # text/plain, so keep the bytes in a spooled buffer
+            buf, size = media.spool(src)
+            with buf:
+                media_upload = _upload_whatsapp_media(file_name, mime_type, media.iter_file(buf), size)
+
+                if not media_upload.ok and "Param file must be a file with one of the following types" in media_upload.text:
+                    print(f"Unsupported MIME type '{mime_type}', retrying as text/plain")
+                    mime_type = "text/plain"
+                    if not file_name.endswith(".txt"):
+                        file_name = file_name + ".txt"
+                    buf.seek(0)
+                    media_upload = _upload_whatsapp_media(file_name, mime_type, media.iter_file(buf), size)
+
+    if not _accepted(media_upload, "WhatsApp media upload"):
+        return None
+
+    uploaded = {"id": media_upload.json().get("id"), "mime": mime_type, "name": file_name}
+    MEDIA_CACHE.put(key, uploaded, size, ttl=media.WHATSAPP_MEDIA_TTL)
+    return uploaded
 
 # Zulip recipient list
 def _recip_list(chat: dict) -> list[str]:
@@ -144,229 +416,339 @@ def _register_chat(phone: str, ticket_id: int | None, eng_email: str | None, top
         "last_customer_ts": time.time(),  # start timer at creation (the customer just sent a message)
     }
 
-    db.state["phone_to_chat"][phone] = chat
-    db.save()
+    db.put_chat(phone, chat)
     return chat
 
-# 
-
-import re, html
-from urllib.parse import urljoin
-
-# reuse your existing ZULIP_BASE_URL logic or define it directly
-# ZULIP_BASE_URL = ZULIP_API_URL.split('/api', 1)[0]
-
-def _format_transcript_html(ticket_id: int, lines: list[str]) -> str:
+def _format_transcript_html(ticket_id: int, lines: list[str], first_index: int = 1) -> str:
     """
-    Rewritten visual style:
-      - Card-based chat log instead of a table
-      - Colored role pill (Customer → Engineer / Engineer → Customer / Note)
-      - Subtle message index on the right
-      - Minimal inline styles (RT-friendly); readable even if styles are stripped
-      - URL and /user_uploads links are auto-linked
+    Card-based HTML chat log for an RT comment, see transcript.py.
     """
-    ZULIP_BASE_URL = ZULIP_API_URL.split('/api', 1)[0]
+    return transcript.render(ticket_id, lines, ZULIP_BASE_URL, first_index)
 
-    def linkify(s: str) -> str:
-        s = re.sub(
-            r'(https?://[^\s<]+)',
-            lambda m: f'<a href="{html.escape(m.group(0))}" target="_blank" rel="noopener">{html.escape(m.group(0))}</a>',
-            s,
-        )
-        s = re.sub(
-            r'(/user_uploads/[^\s<]+)',
-            lambda m: f'<a href="{html.escape(urljoin(ZULIP_BASE_URL, m.group(1)))}" target="_blank" rel="noopener">Download</a>',
-            s,
-        )
-        return s
-
-    cards = []
-    for i, raw in enumerate(lines, 1):
-        direction = "Note"
-        content = raw
-        link_url = None
-        pill_bg = "#e5e7eb"  # neutral
-        pill_fg = "#111827"
-
-        m = re.match(r'^(Customer to ENG|ENG to Customer):\s*(.*)$', raw, re.I)
-        if m:
-            direction_key = m.group(1).lower()
-            if "customer to eng" in direction_key:
-                direction = "Customer → Engineer"
-                pill_bg, pill_fg = "#dbeafe", "#1e3a8a"  # blue
-            else:
-                direction = "Engineer → Customer"
-                pill_bg, pill_fg = "#dcfce7", "#14532d"  # green
-            content = m.group(2)
-
-        m2 = re.match(r'^Customer sent (?:image|file):\s*(.*?)(?:\s*<(.+?)>)?\s*$', raw, re.I)
-        if m2:
-            direction = "Customer → Engineer"
-            pill_bg, pill_fg = "#dbeafe", "#1e3a8a"
-            content = m2.group(1)
-            link_url = m2.group(2)
-
-        m3 = re.match(r'^ENG sent file:\s*(.*?)(?:\s*\(as [^)]+\))?(?:\s*<(.+?)>)?\s*$', raw, re.I)
-        if m3:
-            direction = "Engineer → Customer"
-            pill_bg, pill_fg = "#dcfce7", "#14532d"
-            content = m3.group(1)
-            link_url = m3.group(2)
-
-        safe = html.escape(content).replace("\n", "<br>")
-
-        if link_url:
-            if link_url.startswith("/"):
-                link_url = urljoin(ZULIP_BASE_URL, link_url)
-            safe += f'<br><a href="{html.escape(link_url)}" target="_blank" rel="noopener">Link to Media</a>'
-        else:
-            safe = linkify(safe)
-
-        card = f"""
-        <div style="border:1px solid #e5e7eb;border-radius:12px;padding:12px 14px;margin:10px 0;background:#ffffff;">
-          <div style="display:flex;align-items:center;justify-content:space-between;margin-bottom:6px;">
-            <span style="display:inline-block;padding:3px 10px;border-radius:999px;background:{pill_bg};color:{pill_fg};font-size:12px;font-weight:600;">
-              {html.escape(direction)}
-            </span>
-            <span style="font-size:12px;color:#6b7280;">#{i}</span>
-          </div>
-          <div style="font-size:14px;color:#111827;line-height:1.5;">{safe}</div>
-        </div>
-        """
-        cards.append(card)
-
-    return f"""<!DOCTYPE html>
-<html>
-<head>
-  <meta charset="utf-8">
-  <title>Transcript #{ticket_id}</title>
-</head>
-<body style="background:#f9fafb;margin:0;padding:0;font-family:ui-sans-serif,system-ui,-apple-system,Segoe UI,Roboto,Ubuntu,Cantarell,Noto Sans,sans-serif;">
-  <div style="max-width:820px;margin:24px auto;padding:0 16px;">
-    <div style="margin-bottom:14px;">
-      <h2 style="margin:0 0 6px 0;font-size:20px;color:#111827;">WhatsApp ↔ Zulip Transcript</h2>
-      <div style="font-size:13px;color:#6b7280;">Ticket #{ticket_id}</div>
-    </div>
-    {''.join(cards)}
-  </div>
-</body>
-</html>"""
-
-
-
-def _push_transcript(ticket_id: int):
-    lines = db.state["transcripts"].get(str(ticket_id), [])
+def _push_transcript(ticket_id: int, final: bool = False) -> bool | None:
+    """
+    Post the transcript lines not yet sent to RT as an HTML comment and move
+    the ticket's push cursor past them. The transcript itself is kept until
+    the chat closes (`final=True`), then dropped. True when RT accepted the
+    comment (or there was nothing new to post), None when a final push has
+    to wait for attachments still in the outbox.
+    """
+    if final and _media_queued(ticket_id):
+        # their lines are logged once they are delivered; dropping the
+        # transcript before that would strand them
+        return None
+    start = db.get_push_cursor(ticket_id)
+    lines = db.get_transcript(ticket_id, start)
     if not lines:
-        return
+        if final:
+            db.drop_transcript(ticket_id)
+        return True
     
-    html_body = _format_transcript_html(ticket_id, lines)
+    html_body = _format_transcript_html(ticket_id, lines, first_index=start + 1)
 
-    url = f"{os.environ['RT_BASE_URL'].rstrip('/')}/ticket/{ticket_id}/comment"
-    headers_base = {"Authorization": f"token {os.environ['RT_TOKEN']}"}
+    url = f"{RT_BASE_URL}/ticket/{ticket_id}/comment"
 
     # Preferred: RT REST2 JSON with ContentType=text/html
-    resp = requests.post(
+    resp = RT.post(
         url,
-        headers={**headers_base, "Content-Type": "application/json"},
+        op="rt_comment",
         json={"ContentType": "text/html", "Content": html_body},
-        timeout=15,
     )
 
     # Fallback: some setups accept raw body with request Content-Type text/html
     if resp.status_code != 201:
-        resp = requests.post(
+        resp = RT.post(
             url,
-            headers={**headers_base, "Content-Type": "text/html"},
+            op="rt_comment",
+            headers={"Content-Type": "text/html"},
             data=html_body.encode("utf-8"),
-            timeout=15,
         )
 
 
     if resp.status_code != 201:
-        print("RT comment failed:", resp.status_code, resp.text)
-        return
+        if resp.ok or not _delivered(resp, "RT comment"):
+            print("RT comment failed:", resp.status_code, resp.text)
+            return False
+        # rejected for good (ticket deleted, no permission): nothing to retry
+        if final:
+            db.drop_transcript(ticket_id)
+        return True
+
+    # on success advance the cursor, or drop the transcript once the chat is closed
+    if final:
+        db.drop_transcript(ticket_id)
+    else:
+        db.set_push_cursor(ticket_id, start + len(lines))
+    return True
+
+# failed deliveries go to the outbox and are retried in the background (outbox.py)
+def _delivered(resp, what: str) -> bool:
+    """
+    True when `resp` needs no retry: it succeeded, or the upstream rejected
+    it for good (4xx other than 429).
+    """
+    if resp.ok:
+        return True
+    if resp.status_code == 429 or resp.status_code >= 500:
+        return False
+    print(f"{what} rejected, not retrying:", resp.status_code, resp.text)
+    return True
+
+def _accepted(resp, what: str) -> bool:
+    """
+    For one step of a media relay: True when `resp` succeeded, False when the
+    upstream rejected it for good. Raises otherwise, so the outbox retries.
+    """
+    if resp.ok:
+        return True
+    if _delivered(resp, what):
+        return False
+    raise requests.HTTPError(f"{what} failed: {resp.status_code}", response=resp)
+
+def _deliver_zulip_post(stream: str, topic: str, content: str) -> bool:
+    return _delivered(_send_zulip_dm_stream(stream, topic, content), "Zulip post")
+
+def _deliver_whatsapp_text(to: str, body: str) -> bool:
+    return _delivered(_do_send_whatsapp(to, body), "WhatsApp send")
+
+def _media_queued(ticket_id: int) -> bool:
+    return any(e["kind"] in ("customer_media", "engineer_media") and e["args"]["ticket_id"] == ticket_id
+               for e in db.outbox().values())
+
+def _deliver_customer_media(ticket_id: int, topic: str, media_id: str, upload_name: str, mime_type: str,
+                            sha256: str | None, caption: str, label: str, stream: str = "SupportChat-test") -> bool:
+    """
+    Copy a customer's WhatsApp media to Zulip, post it to the chat's topic
+    and log it.
+    """
+    upload_uri = _relay_whatsapp_media(media_id, upload_name, mime_type, sha256)
+    if not upload_uri:
+        # rejected for good: don't hold up the topic's later posts
+        return _deliver_zulip_post(stream, topic, f"Could not relay attachment from customer: {label}\n{caption}")
+    if not _deliver_zulip_post(stream, topic, f"[{label}]({upload_uri})\n{caption}"):
+        return False
+    _log_line(ticket_id, transcript.TO_ENGINEER, caption, upload_uri, mime_type)
+    return True
+
+def _deliver_engineer_media(to: str, ticket_id: int, relative_url: str, file_name: str, caption: str,
+                            topic: str | None = None) -> bool:
+    """
+    Copy an engineer's Zulip upload to Graph, send it to the customer and log it.
+    """
+    uploaded = _relay_zulip_file(relative_url, file_name)
+    if not uploaded:
+        # rejected for good: tell the engineer, don't hold up the customer's texts
+        if topic:
+            _post_to_stream(topic, f"Could not relay attachment to customer: {file_name}")
+        return True
+    media_id, mime_type, file_name = uploaded["id"], uploaded["mime"], uploaded["name"]
+
+    if mime_type.startswith("image/"):
+        wa_payload = {
+            "messaging_product": "whatsapp",
+            "to": to,
+            "type": "image",
+            "image": {
+                "id": media_id,
+                "caption": caption
+            }
+        }
+    else:
+        wa_payload = {
+            "messaging_product": "whatsapp",
+            "to": to,
+            "type": "document",
+            "document": {
+                "id": media_id,
+                "caption": caption,
+                "filename": file_name
+            }
+        }
+
+    resp = GRAPH.post(
+        f"{GRAPH_API_URL}/{BUSINESS_PHONE_NUMBER_ID}/messages",
+        op="whatsapp_send",
+        json=wa_payload
+    )
+    if not _delivered(resp, "WhatsApp media send"):
+        return False
+    _log_line(ticket_id, transcript.TO_CUSTOMER, file_name, mime=mime_type)
+    return True
+
+def _drop_final_transcript(ticket_id: int, final: bool):
+    if final:
+        db.drop_transcript(ticket_id)
+
+OUTBOX = outbox.Outbox()
+OUTBOX.register("zulip_post", "zulip", _deliver_zulip_post)
+OUTBOX.register("whatsapp_text", "graph", _deliver_whatsapp_text)
+OUTBOX.register("rt_transcript", "rt", _push_transcript, give_up=_drop_final_transcript)
+OUTBOX.register("customer_media", "zulip", _deliver_customer_media)
+OUTBOX.register("engineer_media", "graph", _deliver_engineer_media)
+
+def _post_to_stream(topic: str, content: str, stream: str = "SupportChat-test") -> bool:
+    """
+    Post to a topic now or, if that fails, from the outbox. True if posted now.
+    """
+    return OUTBOX.deliver("zulip_post", {"stream": stream, "topic": topic, "content": content},
+                          order=f"zulip:{topic}")
+
+def _send_whatsapp_text(to: str, body: str) -> bool:
+    return OUTBOX.deliver("whatsapp_text", {"to": to, "body": body}, order=f"whatsapp:{to}")
 
-    # on success, drop transcript
-    db.state["transcripts"].pop(str(ticket_id), None)
-    db.save()
+def _push_or_queue_transcript(ticket_id: int | None, final: bool = False) -> bool:
+    """
+    _push_transcript, handing the ticket to the outbox when RT is not
+    accepting comments. One outbox entry per ticket; once a final push is
+    queued the entry stays final.
+    """
+    if ticket_id is None:
+        print("No RT ticket, transcript not pushed")
+        return False
+    key = f"rt_transcript:{ticket_id}"
+    pending = db.get_outbox(key)
+    final = final or bool(pending and pending["args"]["final"])
+    return OUTBOX.deliver("rt_transcript", {"ticket_id": ticket_id, "final": final}, order=key, key=key)
 
+@_locks_phone
 def _end_chat(phone: str, chat: dict):
+    _flush_customer_text(phone, chat)
     ticket_id = chat["ticket"]
     topic = chat.get("topic")
 
-    # notify customer + stream
-    _do_send_whatsapp(phone, "Chat closed by engineer. Thank you!")
-    if topic:
-        _send_zulip_dm_stream("SupportChat-test", topic, "Chat with customer closed. Transcript will be posted to RT.")
-
-    # push transcript to RT
-    try:
-        _push_transcript(ticket_id)
+    # notify customer + stream and push what is left of the transcript to RT, all at once
+    # (anything that fails is retried from the outbox after the chat is gone)
+    _, _, pushed = outbound.gather(
+        lambda: _send_whatsapp_text(phone, "Chat closed by engineer. Thank you!"),
+        lambda: topic and _post_to_stream(topic, "Chat with customer closed. Transcript will be posted to RT."),
+        lambda: _push_or_queue_transcript(ticket_id, final=True),
+        return_exceptions=True,
+    )
+    if pushed is True:
         print("Pushed transcript to RT")
-    except Exception as e:
-        print("Could not push transcript to RT:", e)
+    else:
+        print("Could not push transcript to RT yet:", pushed)
 
-    # clean up state
-    db.state["phone_to_chat"].pop(phone, None)
-    db.save()
+    # clean up state; the closed chat (and any queued transcript push) must be
+    # on disk before the job is done
+    db.pop_chat(phone)
+    db.flush()
 
 def _cleanup_expired_chats():
+    with CLEANUP_SECONDS.time():
+        _sweep_expired_chats()
+
+def _sweep_expired_chats():
     now = time.time()
-    expired = []
     with EXPIRY_LOCK:
-        for phone, chat in list(db.state.get("phone_to_chat", {}).items()):
-            if chat.get("expired"):
-                continue  # already processed
-            last_ts = chat.get("last_customer_ts")
-            if last_ts and (now - last_ts) > CHAT_TTL_SECONDS:
-                chat["expired"] = True  # mark first to avoid double processing
-                expired.append((phone, chat))
-
-    for phone, chat in expired:
-        topic = chat.get("topic")
-        try:
-            if topic:
-                _send_zulip_dm_stream(
-                    "SupportChat-test",
-                    topic,
-                    "Chat expired after inactivity. Pushing transcript to RT and notifying customer."
-                )
-        except Exception as e:
-            print("Stream notify failed during cleanup:", e)
-        try:
-            _do_send_whatsapp(
-                phone,
-                "Your support chat has expired due to inactivity. The transcript was archived. "
-                "Reply with the subject of a new issue to start a fresh ticket."
-            )
-        except Exception as e:
-            print("WhatsApp notify failed during cleanup:", e)
+        # deadline index: only chats that are actually past their TTL come back
+        expired = db.take_idle_chats(now - CHAT_TTL_SECONDS)
+
+    futures = [EXPIRY_POOL.submit(_expire_chat, phone, chat) for phone, chat in expired]
+    for fut in as_completed(futures):
         try:
-            _push_transcript(chat["ticket"])
-            print(f"Pushed transcript to RT for expired chat ticket {chat['ticket']}")
+            result = fut.result()
+            if result is None:
+                continue
+            print("Expired chat:", result)
+            CHATS_EXPIRED.inc()
         except Exception as e:
-            print("Could not push transcript during cleanup:", e)
-        db.state["phone_to_chat"].pop(phone, None)
+            print("Expiry failed:", e)
+
+@_locks_phone
+def _expire_chat(phone: str, chat: dict) -> dict | None:
+    """
+    Notify stream + customer, push the transcript and drop the chat. Returns
+    what happened to each step so one slow or failing upstream is visible per
+    chat, or None when the customer wrote again (or the chat closed) since
+    the chat was picked for expiry.
+    """
+    current = db.get_chat(phone)
+    if current is None or current.get("last_customer_ts") != chat.get("last_customer_ts"):
+        return None
+    # buffered texts are forwarded first and move last_customer_ts, so the
+    # chat isn't expired after all
+    _flush_customer_text(phone, current)
+    # re-checked and dropped in one transaction: in sqlite mode another
+    # worker may have taken a message for this chat (or expired it) meanwhile
+    with db.transaction():
+        current = db.get_chat(phone)
+        if current is None or current.get("last_customer_ts") != chat.get("last_customer_ts"):
+            return None
+        db.pop_chat(phone)
+    topic = chat.get("topic")
 
-    if expired:
-        db.save()
+    def notify_stream():
+        if not topic:
+            return "skipped"
+        posted = _post_to_stream(
+            topic,
+            "Chat expired after inactivity. Pushing transcript to RT and notifying customer."
+        )
+        return "ok" if posted else "queued"
 
+    def notify_customer():
+        sent = _send_whatsapp_text(
+            phone,
+            "Your support chat has expired due to inactivity. The transcript was archived. "
+            "Reply with the subject of a new issue to start a fresh ticket."
+        )
+        return "ok" if sent else "queued"
+
+    def push():
+        if not _push_or_queue_transcript(chat["ticket"], final=True):
+            return "queued"
+        print(f"Pushed transcript to RT for expired chat ticket {chat['ticket']}")
+        return "ok"
+
+    # the three steps are independent, run them side by side
+    zulip, whatsapp, rt = outbound.gather(notify_stream, notify_customer, push, return_exceptions=True)
+    for step, outcome in (("Stream notify", zulip), ("WhatsApp notify", whatsapp), ("Transcript push", rt)):
+        if isinstance(outcome, Exception):
+            print(f"{step} failed during cleanup:", outcome)
+    result = {"phone": phone, "ticket": chat.get("ticket")}
+    result.update((k, repr(v) if isinstance(v, Exception) else v)
+                  for k, v in (("zulip", zulip), ("whatsapp", whatsapp), ("rt", rt)))
+    db.flush()
+    return result
+
+
+def _seconds_until_next_expiry() -> float:
+    """
+    Sleep until the oldest chat hits its TTL, but at least every
+    CLEANUP_INTERVAL_SECONDS for journal compaction and the like.
+    """
+    oldest = db.oldest_customer_ts()
+    if oldest is None:
+        return CLEANUP_INTERVAL_SECONDS
+    due = oldest + CHAT_TTL_SECONDS - time.time()
+    return min(CLEANUP_INTERVAL_SECONDS, max(due, 0.05))
 
 # Cleanup loop (Flask 3 compatible)
 def _start_cleanup_loop():
-    global _CLEANUP_STARTED
+    global _CLEANUP_STARTED, CLEANUP_LEASE
     if _CLEANUP_STARTED:
         return
     _CLEANUP_STARTED = True
+    # created here, not at import, so each gunicorn worker gets its own pid in the lease
+    CLEANUP_LEASE = leader.Lease(CLEANUP_LEASE_FILE, CLEANUP_LEASE_SECONDS)
+    CLEANUP_LEASE.start(CLEANUP_STOP)
 
     def loop():
         print(f"Cleanup thread started (interval={CLEANUP_INTERVAL_SECONDS}s, ttl={CHAT_TTL_SECONDS}s)")
         while not CLEANUP_STOP.is_set():
+            # followers do no sweep work, they just wait to take over
+            if not CLEANUP_LEASE.held:
+                CLEANUP_STOP.wait(CLEANUP_LEASE_SECONDS / 3)
+                continue
+            wait = CLEANUP_INTERVAL_SECONDS
             try:
                 _cleanup_expired_chats()
+                db.maybe_compact()
+                wait = _seconds_until_next_expiry()
             except Exception as e:
                 print("Cleanup loop error:", e)
-            CLEANUP_STOP.wait(CLEANUP_INTERVAL_SECONDS)
+            CLEANUP_STOP.wait(min(wait, CLEANUP_LEASE_SECONDS / 3))
         print("Cleanup thread stopping.")
 
     threading.Thread(target=loop, daemon=True).start()
@@ -375,8 +757,37 @@ def _start_cleanup_loop():
 def _ensure_cleanup_thread():
     _start_cleanup_loop()
 
+@app.before_request
+def _ensure_job_workers():
+    JOBS.start()
+    OUTBOX.start()
+
+@app.before_request
+def _start_request_timer():
+    request.environ["bridge.started"] = time.perf_counter()
+
+@app.after_request
+def _observe_request_time(resp):
+    started = request.environ.get("bridge.started")
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        HTTP_SECONDS.observe(elapsed, request.endpoint or "unknown", resp.status_code)
+        if CAPTURE and request.endpoint in _CAPTURED:
+            CAPTURE.record(_CAPTURED[request.endpoint], request.path, request.headers.items(),
+                           request.get_data(), resp.status_code, time.time() - elapsed, elapsed)
+    return resp
+
 def _shutdown_cleanup(*_):
     CLEANUP_STOP.set()
+    if CLEANUP_LEASE:
+        CLEANUP_LEASE.release()
+    _flush_all_customer_text()
+    JOBS.stop()
+    OUTBOX.stop()
+    outbound.shutdown(wait=True)
+    db.flush()
+    if CAPTURE:
+        CAPTURE.close()
 
 atexit.register(_shutdown_cleanup)
 for _sig in (signal.SIGINT, signal.SIGTERM):
@@ -394,53 +805,158 @@ def verify_webhook():
         return request.args.get("hub.challenge"), 200
     return "Forbidden", 403
 
+def _admitted(endpoint: str):
+    """
+    Webhook admission: beyond WEBHOOK_MAX_INFLIGHT concurrent requests the
+    webhook gets an immediate 503 instead of a request thread.
+    """
+    def wrap(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _WEBHOOK_SLOTS is None:
+                return fn(*args, **kwargs)
+            if not _WEBHOOK_SLOTS.acquire(blocking=False):
+                WEBHOOKS_SHED.inc(endpoint, "inflight")
+                return "Busy", 503, {"Retry-After": str(SHED_RETRY_AFTER)}
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _WEBHOOK_SLOTS.release()
+        return wrapper
+    return wrap
+
+def _shed(endpoint: str, e: jobs.QueueFull) -> tuple[int, dict]:
+    """
+    Status and headers for a webhook the job queue refused: 429 when one
+    chat has too much queued, 503 when the bridge as a whole is behind.
+    """
+    WEBHOOKS_SHED.inc(endpoint, e.reason)
+    return (429 if isinstance(e, jobs.KeyBusy) else 503), {"Retry-After": str(SHED_RETRY_AFTER)}
+
 @app.post("/webhook")
+@_admitted("whatsapp")
 def receive_whatsapp():
     if not _verify_meta_signature():
         return "Invalid signature", 403
     
     body = request.get_json(force=True)
-    msg  = (body.get("entry",[{}])[0].get("changes",[{}])[0]
-                  .get("value",{}).get("messages",[{}])[0])
-    
-    print(msg)
-    
-    if not msg:
+
+    # Meta may batch several entries / changes / messages into one delivery:
+    # group the messages by customer so each chat is handled in order, and
+    # only count status callbacks (sent / delivered / read)
+    by_phone = {}
+    statuses = 0
+    for entry in body.get("entry", []):
+        for change in entry.get("changes", []):
+            value = change.get("value", {})
+            phone_id = value.get("metadata", {}).get("phone_number_id", BUSINESS_PHONE_NUMBER_ID)
+            statuses += len(value.get("statuses", []))
+            for msg in value.get("messages", []):
+                print(msg)
+                if not _claim_message(f"wa:{msg['id']}"):
+                    print(f"Duplicate WhatsApp message {msg['id']}, skipping")
+                    continue
+                by_phone.setdefault(msg["from"], []).append((msg, phone_id))
+
+    if statuses:
+        print(f"Ignoring {statuses} WhatsApp status callback(s)")
+    if not by_phone:
         return "", 200
 
+    try:
+        JOBS.submit_all([(phone, _handle_whatsapp_batch, (msgs,), {}) for phone, msgs in by_phone.items()])
+    except jobs.QueueFull as e:
+        print("Rejecting WhatsApp webhook:", e)
+        for msgs in by_phone.values():
+            for msg, _ in msgs:
+                db.release_message(f"wa:{msg['id']}")
+        return "Busy", *_shed("whatsapp", e)
+    return "", 200
+
+def _claim_message(key: str) -> bool:
+    """
+    True the first time a webhook message id is seen, False for a redelivery.
+    """
+    return db.claim_message(key, DEDUP_TTL_SECONDS, DEDUP_MAX_ENTRIES)
+
+def _handle_whatsapp_batch(msgs: list[tuple[dict, str]]):
+    """
+    Handle one customer's messages from a delivery in order, then mark the
+    last forwarded one read (WhatsApp marks everything before it read too).
+    """
+    last_read = None
+    for msg, phone_id in msgs:
+        try:
+            with _phone_lock(msg["from"]):
+                handled = _handle_whatsapp(msg)
+            if handled:
+                last_read = (msg, phone_id)
+        except Exception as e:
+            print(f"WhatsApp message {msg.get('id')} failed:", repr(e))
+
+    # nothing waits on the read receipt, so it doesn't hold up this chat's next job
+    if last_read:
+        msg, phone_id = last_read
+        outbound.submit(GRAPH.post, f"{GRAPH_API_URL}/{phone_id}/messages", op="whatsapp_read",
+                        json={"messaging_product":"whatsapp",
+                              "status":"read", "message_id": msg["id"]})
+
+def _advance_intake(phone: str, seen: dict | None, new: dict | None) -> bool:
+    """
+    Move `phone`'s intake from `seen` to `new` (None drops it). False, and
+    nothing changed, when another worker moved it first or a chat is open.
+    """
+    with db.transaction():
+        if db.get_chat(phone) is not None or db.get_pending(phone) != seen:
+            return False
+        if new is None:
+            db.pop_pending(phone)
+        else:
+            db.put_pending(phone, new)
+        return True
+
+def _handle_whatsapp(msg: dict) -> bool:
+    """
+    Handle one customer message. True when it was forwarded to the stream
+    (and should be marked read).
+    """
     msg_type = msg.get("type")
     phone = msg["from"]
 
-    db.state.setdefault("pending_rts", {})
-    pending = db.state["pending_rts"]
-
-    chat = db.state["phone_to_chat"].get(phone)
+    chat = db.get_chat(phone)
 
     if not chat:
         print("no chat for this phone number")
 
     if not chat and msg_type == "text":
         text = msg["text"]["body"].strip()
-        state = pending.get(phone)
+        state = db.get_pending(phone)
+        stage = state and state["stage"]
+        if stage == "creating" and time.time() - state.get("claimed_at", 0) > INTAKE_CLAIM_SECONDS:
+            stage = "ask_description"   # the worker creating the ticket died
 
+        # each step is claimed before its replies go out, so a message
+        # redelivered to another worker can't run it twice
         if state is None:
-            _do_send_whatsapp(phone,
+            if not _advance_intake(phone, state, {"stage": "ask_subject"}):
+                return False
+            _send_whatsapp_text(phone,
                 "Hi! It looks like you're not currently in a chat.\n"
                 "Would you like to open a new support ticket? If so, please reply with the *subject line* of your issue."
             )
-            pending[phone] = {"stage": "ask_subject"}
-            db.save()
-            return "", 200
-
-        elif state["stage"] == "ask_subject":
-            pending[phone]["subject"] = text
-            pending[phone]["stage"] = "ask_description"
-            _do_send_whatsapp(phone, "Thanks! Now, please describe your issue.")
-            db.save()
-            return "", 200
-
-        elif state["stage"] == "ask_description":
-            subject = pending[phone]["subject"]
+            return False
+
+        elif stage == "ask_subject":
+            if not _advance_intake(phone, state, dict(state, subject=text, stage="ask_description")):
+                return False
+            _send_whatsapp_text(phone, "Thanks! Now, please describe your issue.")
+            return False
+
+        elif stage == "ask_description":
+            claim = dict(state, stage="creating", claimed_at=time.time())
+            if not _advance_intake(phone, state, claim):
+                return False
+            subject = state["subject"]
             description = text
             print("\n--- RT Creation Request ---")
             print("Phone:", phone)
@@ -448,41 +964,44 @@ def receive_whatsapp():
             print("Description:", description)
             print("---------------------------\n")
 
-            requests.post(
-                ZULIP_API_URL,
-                data={
-                    "type": "stream",
-                    "to": "SupportChat-test",
-                    "topic": f"{phone} | {subject}",
-                    "content": (
-                        f"New WhatsApp support request:\n\n"
-                        f"Description: {description}"
-                    ),
-                },
-                auth=(ZULIP_BOT_EMAIL, ZULIP_API_KEY),
-                timeout=10
-            )
-            _do_send_whatsapp(phone,
-                "Thanks! We've received your request. An engineer will respond once available."
+            topic = f"{phone} | {subject}"
+            # stream notice, customer reply and RT ticket don't depend on each other
+            notice, thanks, ticket_id = outbound.gather(
+                lambda: _post_to_stream(
+                    topic,
+                    f"New WhatsApp support request:\n\n"
+                    f"Description: {description}"
+                ),
+                lambda: _send_whatsapp_text(phone,
+                    "Thanks! We've received your request. An engineer will respond once available."
+                ),
+                lambda: _create_rt_ticket(topic, "Whatsapp Bridge", "New Ticket from Whatsapp"),
+                return_exceptions=True,
             )
-
-            pending.pop(phone, None)
+            for step, outcome in (("Stream notice", notice), ("WhatsApp reply", thanks), ("RT ticket", ticket_id)):
+                if isinstance(outcome, Exception):
+                    print(f"{step} failed:", repr(outcome))
+            if isinstance(ticket_id, Exception):
+                ticket_id = None
 
             try:
-                chat = _register_chat(phone, None, None, f"{phone} | {subject}")
-            except RuntimeError:
-                return "Register new chat failed -- stream", 200
-            
-            db.save()
-            return "", 200
+                # a failed create (None) is retried once by _register_chat
+                chat = _register_chat(phone, ticket_id, None, topic)
+            except (RuntimeError, requests.RequestException) as e:
+                print("Register new chat failed -- stream:", repr(e))
+                # keep the intake, the customer's next message tries again
+                _advance_intake(phone, claim, {"stage": "ask_description", "subject": subject})
+                return False
+            db.pop_pending(phone)
+            return False
 
         # fallback
-        return "", 200
+        return False
 
     # === Skip RT prompt for media-only messages ===
     if not chat and msg_type in ("image", "document"):
-        _do_send_whatsapp(phone, CLOSED_REPLY)
-        return "", 200
+        _send_whatsapp_text(phone, CLOSED_REPLY)
+        return False
 
     if msg_type == "text":
         text = msg["text"]["body"].strip()
@@ -490,55 +1009,24 @@ def receive_whatsapp():
         media_id = msg["image"]["id"]
         caption = msg["image"].get("caption", "")
 
-        # Get media URL
-        media_resp = requests.get(
-            f"https://graph.facebook.com/v22.0/{media_id}",
-            headers={"Authorization": f"Bearer {GRAPH_API_TOKEN}"}
-        )
-        media_url = media_resp.json().get("url")
-
-        # Download image
-        image_resp = requests.get(
-            media_url,
-            headers={"Authorization": f"Bearer {GRAPH_API_TOKEN}"},
-            stream=True,
-            timeout=10
-        )
-
-        # Save to temp file
-        fname = f"/tmp/{uuid.uuid4()}.jpg"
-        with open(fname, "wb") as f:
-            for chunk in image_resp.iter_content(chunk_size=8192):
-                f.write(chunk)
+        mime_type = msg["image"].get("mime_type") or "image/jpeg"
+        upload_name = f"{media_id}{mimetypes.guess_extension(mime_type) or '.jpg'}"
+        sha256 = msg["image"].get("sha256")
+        label = "Download Image"
 
     elif msg_type == "document":
         media_id = msg["document"]["id"]
         filename = msg["document"]["filename"]
         caption = msg["document"].get("caption", "")
 
-        # Get media URL
-        media_resp = requests.get(
-            f"https://graph.facebook.com/v22.0/{media_id}",
-            headers={"Authorization": f"Bearer {GRAPH_API_TOKEN}"}
-        )
-        media_url = media_resp.json().get("url")
-
-        # Download document
-        doc_resp = requests.get(
-            media_url,
-            headers={"Authorization": f"Bearer {GRAPH_API_TOKEN}"},
-            stream=True,
-            timeout=10
-        )
-
-        # Save to temp file
-        fname = f"/tmp/{uuid.uuid4()}_{filename}"
-        with open(fname, "wb") as f:
-            for chunk in doc_resp.iter_content(chunk_size=8192):
-                f.write(chunk)
+        mime_type = (msg["document"].get("mime_type")
+                     or mimetypes.guess_type(filename)[0] or "application/octet-stream")
+        upload_name = filename
+        sha256 = msg["document"].get("sha256")
+        label = filename
 
     else:
-        return "", 200
+        return False
 
 
     #chat = db.state["phone_to_chat"].get(phone)
@@ -567,52 +1055,29 @@ def receive_whatsapp():
     # forward message
     
     if msg_type == "text":
-        print(f"Customer to stream: {text}")
-        dm_body = text
-        _log_line(chat["ticket"], f"Customer to ENG: {text}")
-        # update last customer activity
-        chat["last_customer_ts"] = time.time()
-        db.save()
-        _send_zulip_dm_stream("SupportChat-test", chat["topic"], dm_body)
-
-    elif msg_type == "image":
-        # Upload image to Zulip
-        zulip_upload = requests.post(
-            "https://chat-test.filmlight.ltd.uk/api/v1/user_uploads",
-            auth=(ZULIP_BOT_EMAIL, ZULIP_API_KEY),
-            files={"file": open(fname, "rb")}
-        )
-        upload_uri = zulip_upload.json().get("uri", "")
-        dm_body = f"[Download Image]({upload_uri})\n{caption}"
-        _log_line(chat["ticket"], f"Customer sent image: {caption} <{upload_uri}>")
-        chat["last_customer_ts"] = time.time()
-        db.save()
-        _send_zulip_dm_stream("SupportChat-test", chat["topic"], dm_body)
-
-    elif msg_type == "document":
-        zulip_upload = requests.post(
-            "https://chat-test.filmlight.ltd.uk/api/v1/user_uploads",
-            auth=(ZULIP_BOT_EMAIL, ZULIP_API_KEY),
-            files={"file": open(fname, "rb")}
-        )
-        upload_uri = zulip_upload.json().get("uri", "")
-        dm_body = f"[{filename}]({upload_uri})\n{caption}"
-        _log_line(chat["ticket"], f"Customer sent file: {caption} <{upload_uri}>")
-        chat["last_customer_ts"] = time.time()
-        db.save()
-        _send_zulip_dm_stream("SupportChat-test", chat["topic"], dm_body)
-
-
-    # mark read
-    phone_id = body["entry"][0]["changes"][0]["value"]["metadata"]["phone_number_id"]
-    requests.post(f"https://graph.facebook.com/v22.0/{phone_id}/messages",
-                  headers={"Authorization": f"Bearer {GRAPH_API_TOKEN}"},
-                  json={"messaging_product":"whatsapp",
-                        "status":"read", "message_id": msg["id"]})
-    return "", 200
+        if COALESCE_WINDOW_SECONDS > 0:
+            _buffer_customer_text(phone, text)
+        else:
+            _forward_customer_text(phone, chat, [text], time.time())
+        return True
+
+    # buffered texts were sent before this attachment
+    _flush_customer_text(phone, chat)
+
+    chat["last_customer_ts"] = time.time()
+    db.put_chat(phone, chat)
+    # the webhook is already acked: a failed download or upload is retried
+    # from the outbox, in order with the topic's other posts
+    OUTBOX.deliver("customer_media",
+                   {"ticket_id": chat["ticket"], "topic": chat["topic"], "media_id": media_id,
+                    "upload_name": upload_name, "mime_type": mime_type, "sha256": sha256,
+                    "caption": caption, "label": label},
+                   order=f"zulip:{chat['topic']}")
+    return True
 
 # Zulip webhook
 @app.post("/webhook/zulip")
+@_admitted("zulip")
 def receive_zulip():
     payload = request.get_json(force=True)
     msg = payload.get("message", {})
@@ -629,132 +1094,87 @@ def receive_zulip():
 
     topic = msg.get("topic") or msg.get("subject")
     phone = (topic or "").split("|", 1)[0].strip()
-    chat  = db.state["phone_to_chat"].get(phone)
-    if not chat:
+    if not phone:
         return jsonify({"status": "no_chat"}), 200
 
+    key = f"zulip:{msg['id']}" if msg.get("id") is not None else None
+    if key and not _claim_message(key):
+        print(f"Duplicate Zulip message {msg['id']}, skipping")
+        return jsonify({"status": "duplicate"}), 200
+
+    try:
+        JOBS.submit(phone, _handle_zulip, phone, msg)
+    except jobs.QueueFull as e:
+        print("Rejecting Zulip webhook:", e)
+        if key:
+            db.release_message(key)
+        return jsonify({"status": "busy"}), *_shed("zulip", e)
+    return jsonify({"status": "queued"}), 200
+
+@_locks_phone
+def _handle_zulip(phone: str, msg: dict) -> str:
+    chat = db.get_chat(phone)
+    if not chat:
+        return "no_chat"
+    _flush_customer_text(phone, chat)
+
     # strip leading @**bot** mentions
     content = re.sub(r'^@\*\*.*?\*\*\s*', '', msg.get("content", "")).strip()
 
     # Commands
     if "!rt" in content.lower():
-        try:
-            _push_transcript(chat["ticket"])
-        except Exception as e:
-            print("Failed to push transcript:", e)
-        return jsonify({"status": "transcript_pushed"}), 200
+        if _push_or_queue_transcript(chat["ticket"]):
+            return "transcript_pushed"
+        return "transcript_queued"
 
     if "!end" in content.lower():
         _end_chat(phone, chat)
-        return jsonify({"status": "chat_ended"}), 200
+        return "chat_ended"
 
     # ---------- attachment block ----------
     ZULIP_UPLOAD_RE = re.compile(r"\[.*?\]\((/user_uploads/.*?)\)")
     match = ZULIP_UPLOAD_RE.search(msg.get("content", ""))
     if match:
         relative_url = match.group(1)
-        zulip_file_url = f"https://chat-test.filmlight.ltd.uk{relative_url}"
         file_name = os.path.basename(relative_url).split('?')[0]
 
-        # Download the image
-        image_resp = requests.get(
-            zulip_file_url,
-            auth=(ZULIP_BOT_EMAIL, ZULIP_API_KEY),
-            stream=True,
-            timeout=10
-        )
-
-        if not image_resp.ok:
-            return jsonify({"status": "zulip_download_failed"}), 500
-
-        # Save to temp file
-        fname = f"/tmp/{uuid.uuid4()}_{file_name}"
-        with open(fname, "wb") as f:
-            for chunk in image_resp.iter_content(chunk_size=8192):
-                f.write(chunk)
-
-        # Upload to WhatsApp
-        mime_type = mimetypes.guess_type(fname)[0] or "application/octet-stream"
-
-        with open(fname, "rb") as f:
-            media_upload = requests.post(
-                f"https://graph.facebook.com/v22.0/{BUSINESS_PHONE_NUMBER_ID}/media",
-                headers={"Authorization": f"Bearer {GRAPH_API_TOKEN}"},
-                files={"file": (os.path.basename(fname), f, mime_type)},
-                data={"messaging_product": "whatsapp", "type": mime_type}
-            )
-
-        if not media_upload.ok and "Param file must be a file with one of the following types" in media_upload.text:
-            print(f"Unsupported MIME type '{mime_type}', retrying as text/plain")
-            mime_type = "text/plain"
-            if not fname.endswith(".txt"):
-                new_fname = fname + ".txt"
-                os.rename(fname, new_fname)
-                fname = new_fname
-                file_name = os.path.basename(fname)
-
-            with open(fname, "rb") as f:
-                media_upload = requests.post(
-                    f"https://graph.facebook.com/v22.0/{BUSINESS_PHONE_NUMBER_ID}/media",
-                    headers={"Authorization": f"Bearer {GRAPH_API_TOKEN}"},
-                    files={"file": (file_name, f, mime_type)},
-                    data={"messaging_product": "whatsapp", "type": mime_type}
-                )
-
-        os.remove(fname)
-
-        if not media_upload.ok:
-            return jsonify({"status": "media_upload_failed", "details": media_upload.text}), 500
-            
-
-
-        media_id = media_upload.json().get("id")
-
-        if mime_type.startswith("image/"):
-            wa_payload = {
-                "messaging_product": "whatsapp",
-                "to": phone,
-                "type": "image",
-                "image": {
-                    "id": media_id,
-                    "caption": msg.get("content", "")
-                }
-            }
-        else:
-            wa_payload = {
-                "messaging_product": "whatsapp",
-                "to": phone,
-                "type": "document",
-                "document": {
-                    "id": media_id,
-                    "caption": msg.get("content", ""),
-                    "filename": file_name
-                }
-            }
-
-        resp = requests.post(
-            f"https://graph.facebook.com/v22.0/{BUSINESS_PHONE_NUMBER_ID}/messages",
-            json=wa_payload,
-            headers={"Authorization": f"Bearer {GRAPH_API_TOKEN}"}
-        )
-
-        _log_line(chat["ticket"], f"ENG sent file: {file_name} (as {mime_type})")   
-
-        return jsonify({"status":"sent image/document"}), 200
+        # retried from the outbox if the download, upload or send fails
+        sent = OUTBOX.deliver("engineer_media",
+                              {"to": phone, "ticket_id": chat["ticket"], "relative_url": relative_url,
+                               "file_name": file_name, "caption": msg.get("content", ""),
+                               "topic": chat.get("topic")},
+                              order=f"whatsapp:{phone}")
+        return "sent image/document" if sent else "queued image/document"
     # ---------- end attachment block ----------
 
     if not content:
-        return jsonify({"status": "empty"}), 200
+        return "empty"
 
-    _log_line(chat["ticket"], f"ENG to Customer: {content}")
-    resp = _do_send_whatsapp(phone, content)
-    return jsonify({"status":"sent" if resp.ok else "error",
-                    "response":resp.json()}), (200 if resp.ok else 500)
+    _log_line(chat["ticket"], transcript.TO_CUSTOMER, content)
+    return "sent" if _send_whatsapp_text(phone, content) else "queued"
 
 # Health check
 @app.get("/health")
 def health(): return "OK", 200
 
+# job queue depth / latency
+@app.get("/health/queue")
+def health_queue(): return jsonify(JOBS.stats()), 200
+
+# queued retries and circuit breaker state
+@app.get("/health/outbox")
+def health_outbox(): return jsonify(OUTBOX.stats()), 200
+
+# media cache hit / miss counters
+@app.get("/health/media")
+def health_media(): return jsonify(MEDIA_CACHE.stats()), 200
+
+# Prometheus text format
+@app.get("/metrics")
+def metrics_endpoint():
+    _state_sizes.update(db.sizes())
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 # main
 if __name__ == "__main__":
     print("Bridge starting on port", PORT)
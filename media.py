@@ -0,0 +1,197 @@
+"""
+Streaming media relay between WhatsApp and Zulip.
+
+A download is piped chunk by chunk into the multipart body of the upload, so
+files never touch /tmp and memory stays at about one chunk. Only when an
+upload may have to be retried are the bytes kept, in a spooled buffer that
+stays in memory up to MEDIA_SPOOL_MAX_BYTES and is deleted on close.
+"""
+import os, tempfile, threading, time, uuid
+from collections import OrderedDict
+
+CHUNK_SIZE      = 64 * 1024
+SPOOL_MAX_BYTES = int(os.getenv("MEDIA_SPOOL_MAX_BYTES", str(8 * 1024 * 1024)))
+# the upstream timeout bounds each read; this bounds a whole download, so a
+# trickling one can't hold a worker indefinitely
+MAX_SECONDS     = float(os.getenv("MEDIA_MAX_SECONDS", "120"))
+# Graph media ids expire after 30 days, stop reusing them a day early
+WHATSAPP_MEDIA_TTL = 29 * 24 * 60 * 60
+
+# MIME types the Graph /media endpoint accepts; anything else is rejected and
+# has to be re-sent as text/plain
+WHATSAPP_MEDIA_TYPES = {
+    "audio/aac", "audio/amr", "audio/mpeg", "audio/mp4", "audio/ogg",
+    "image/jpeg", "image/png", "image/webp",
+    "video/3gpp", "video/mp4",
+    "text/plain", "application/pdf",
+    "application/msword",
+    "application/vnd.ms-excel",
+    "application/vnd.ms-powerpoint",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+}
+
+
+class _SizedBody:
+    """
+    Iterable body with a known length, so requests sends Content-Length
+    instead of chunked transfer encoding.
+    """
+    def __init__(self, parts, size: int):
+        self._parts = parts
+        self._size = size
+
+    def __iter__(self):
+        return iter(self._parts)
+
+    def __len__(self):
+        return self._size
+
+
+def _quote(value: str) -> bytes:
+    return value.replace("\\", "\\\\").replace('"', "%22").replace("\r", "").replace("\n", "").encode("utf-8")
+
+
+def multipart(filename: str, mime: str, chunks, size: int | None = None,
+              fields: dict | None = None, field: str = "file"):
+    """
+    Build a streaming multipart/form-data body around `chunks`.
+    Returns (content_type, body). When `size` (the file length) is known the
+    body carries a length and is sent with Content-Length.
+    """
+    boundary = uuid.uuid4().hex
+    head = b""
+    for name, value in (fields or {}).items():
+        head += (
+            b"--" + boundary.encode() + b"\r\n"
+            b'Content-Disposition: form-data; name="' + _quote(name) + b'"\r\n\r\n'
+            + str(value).encode("utf-8") + b"\r\n"
+        )
+    head += (
+        b"--" + boundary.encode() + b"\r\n"
+        b'Content-Disposition: form-data; name="' + _quote(field) + b'"; filename="' + _quote(filename) + b'"\r\n'
+        b"Content-Type: " + mime.encode() + b"\r\n\r\n"
+    )
+    tail = b"\r\n--" + boundary.encode() + b"--\r\n"
+
+    def parts():
+        yield head
+        for chunk in chunks:
+            if chunk:
+                yield chunk
+        yield tail
+
+    content_type = f"multipart/form-data; boundary={boundary}"
+    if size is None:
+        return content_type, parts()
+    return content_type, _SizedBody(parts(), len(head) + size + len(tail))
+
+
+def content_length(resp) -> int | None:
+    """
+    Length of a streamed download, if the upstream told us and the body is
+    not re-encoded on the way (iter_content decodes gzip).
+    """
+    if resp.headers.get("Content-Encoding"):
+        return None
+    try:
+        return int(resp.headers["Content-Length"])
+    except (KeyError, ValueError):
+        return None
+
+
+def iter_body(resp):
+    """
+    Chunks of a streamed download. Raises TimeoutError once it has taken
+    longer than MEDIA_MAX_SECONDS.
+    """
+    deadline = time.monotonic() + MAX_SECONDS
+    for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+        if time.monotonic() > deadline:
+            resp.close()
+            raise TimeoutError(f"media download took longer than {MAX_SECONDS:g}s")
+        yield chunk
+
+
+def spool(resp):
+    """
+    Copy a streamed download into a SpooledTemporaryFile so it can be
+    uploaded more than once. Returns (file, size), file rewound.
+    """
+    buf = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    for chunk in iter_body(resp):
+        buf.write(chunk)
+    size = buf.tell()
+    buf.seek(0)
+    return buf, size
+
+
+def iter_file(f):
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+class Tap:
+    """
+    Pass chunks through while counting bytes.
+    """
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            self.size += len(chunk)
+            yield chunk
+
+
+class MediaCache:
+    """
+    Size-bounded LRU of content key -> where that content was already uploaded
+    (a Zulip uri or a Graph media id), with optional per-entry expiry.
+    """
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # key -> (value, size, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[2] is not None and entry[2] <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += entry[1]
+            return entry[0]
+
+    def put(self, key: str, value, size: int = 0, ttl: float | None = None):
+        with self._lock:
+            self._entries[key] = (value, size, time.time() + ttl if ttl else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bytes_saved": self.bytes_saved,
+                "evictions": self.evictions,
+            }
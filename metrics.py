@@ -0,0 +1,135 @@
+"""
+Minimal in-process metrics registry, rendered in the Prometheus text format
+by GET /metrics.
+
+Counters and histograms are plain dicts keyed by label values behind one lock
+each, so recording a sample is a dict lookup and a few additions. Gauges are
+callbacks evaluated at scrape time. Values are per process: with several
+gunicorn workers each one reports its own.
+"""
+import bisect, threading, time
+from contextlib import contextmanager
+
+# seconds; covers a fast keep-alive call up to a slow media upload
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *values, amount: float = 1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for values, v in sorted(self._values.items()):
+                out.append(f"{self.name}{_labels(self.labels, values)} {v}")
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name, self.help, self.labels = name, help, labels
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}   # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, *values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(values)
+            if s is None:
+                s = self._series[values] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    @contextmanager
+    def time(self, *values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *values)
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        with self._lock:
+            series = sorted((k, list(v)) for k, v in self._series.items())
+        for values, s in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets, s):
+                cumulative += n
+                out.append(f"{self.name}_bucket{_labels(names, values + (bound,))} {cumulative}")
+            out.append(f"{self.name}_bucket{_labels(names, values + ('+Inf',))} {s[-1]}")
+            out.append(f"{self.name}_sum{_labels(self.labels, values)} {s[-2]}")
+            out.append(f"{self.name}_count{_labels(self.labels, values)} {s[-1]}")
+        return out
+
+
+class Gauge:
+    """
+    Value read from `fn()` at scrape time. `fn` returns a number, or a dict
+    of label-value tuple -> number when the gauge has labels.
+    """
+    def __init__(self, name: str, help: str, fn, labels: tuple = ()):
+        self.name, self.help, self.labels, self.fn = name, help, labels, fn
+        _registry.append(self)
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.fn()
+        except Exception as e:
+            print(f"Gauge {self.name} failed:", repr(e))
+            return out
+        items = value.items() if self.labels else [((), value)]
+        for values, v in items:
+            out.append(f"{self.name}{_labels(self.labels, values)} {v}")
+        return out
+
+
+def render() -> str:
+    lines = []
+    for metric in list(_registry):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# metrics recorded by the shared modules; main.py adds its own
+UPSTREAM_SECONDS = Histogram(
+    "bridge_upstream_request_seconds", "Outbound HTTP call latency.", ("upstream", "op"))
+UPSTREAM_ERRORS = Counter(
+    "bridge_upstream_errors_total", "Outbound HTTP calls that raised or returned >= 400.",
+    ("upstream", "op", "reason"))
+JOB_SECONDS = Histogram(
+    "bridge_job_seconds", "Time a webhook job spent running on a worker.", ("job",))
+JOB_WAIT_SECONDS = Histogram(
+    "bridge_job_wait_seconds", "Time a webhook job spent queued before a worker took it.", ("job",))
+JOBS_REJECTED = Counter(
+    "bridge_jobs_rejected_total", "Webhook jobs refused by the job queue's admission limits.", ("reason",))
+DB_WRITE_SECONDS = Histogram(
+    "bridge_db_write_seconds", "Time spent persisting state.", ("kind",))
+DB_WRITE_BYTES = Counter(
+    "bridge_db_written_bytes_total", "Bytes written to the state files.", ("kind",))
@@ -0,0 +1,66 @@
+"""
+Fan-out for independent upstream calls.
+
+A handler that makes several calls which don't depend on each other (mark a
+message read, notify the stream, create the RT ticket) hands them to
+`gather` and waits for the slowest one instead of the sum of all of them;
+`submit` starts a call without waiting for it at all.
+
+The HTTP client (requests) is blocking, so the calls run on a shared thread
+pool rather than an event loop. Per-host limits are the concurrency slots of
+the Upstream each call goes through (one Upstream per host), so fanning out
+never puts more requests on a host than it allows.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", "16"))
+
+_pool = ThreadPoolExecutor(max_workers=OUTBOUND_WORKERS, thread_name_prefix="outbound")
+
+
+def _log_failure(fut):
+    if not fut.cancelled() and fut.exception() is not None:
+        print("Background call failed:", repr(fut.exception()))
+
+
+def submit(fn, *args, **kwargs):
+    """
+    Run `fn(*args, **kwargs)` in the background; failures are only logged.
+    """
+    fut = _pool.submit(fn, *args, **kwargs)
+    fut.add_done_callback(_log_failure)
+    return fut
+
+
+def gather(*calls, return_exceptions: bool = False) -> list:
+    """
+    Run zero-argument callables concurrently and return their results in
+    order. The first one runs on the calling thread. Like asyncio.gather, the
+    first exception is raised once every call has finished, or returned in
+    place of the result with `return_exceptions=True`.
+
+    Must not be called from a call that is itself running on this pool.
+    """
+    if not calls:
+        return []
+    futures = [_pool.submit(call) for call in calls[1:]]
+    results = []
+    try:
+        results.append(calls[0]())
+    except Exception as e:
+        results.append(e)
+    for fut in futures:
+        try:
+            results.append(fut.result())
+        except Exception as e:
+            results.append(e)
+    if not return_exceptions:
+        for r in results:
+            if isinstance(r, Exception):
+                raise r
+    return results
+
+
+def shutdown(wait: bool = False):
+    _pool.shutdown(wait=wait, cancel_futures=not wait)
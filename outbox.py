@@ -0,0 +1,220 @@
+"""
+Durable outbox for deliveries that failed (RT comments, Zulip posts,
+WhatsApp texts, media relayed either way).
+
+A delivery is tried right away; if it fails it is stored in the `outbox`
+collection (so it survives restarts) and retried by a background thread with
+exponential backoff and full jitter. Each upstream has a circuit breaker:
+after a run of failures it opens for a cool-down and deliveries for that
+upstream go straight to the outbox without being tried. Deliveries that
+share an `order` key (e.g. one Zulip topic) are delivered in order: while one
+is queued, later ones queue behind it.
+"""
+import os, random, threading, time, uuid
+import db, metrics
+
+OUTBOX_BASE_DELAY   = float(os.getenv("OUTBOX_BASE_DELAY", "5"))
+OUTBOX_MAX_DELAY    = float(os.getenv("OUTBOX_MAX_DELAY", "600"))
+OUTBOX_MAX_AGE      = float(os.getenv("OUTBOX_MAX_AGE", str(7 * 24 * 60 * 60)))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "2"))
+BREAKER_THRESHOLD   = int(os.getenv("OUTBOX_BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN    = float(os.getenv("OUTBOX_BREAKER_COOLDOWN", "30"))
+# a claimed delivery is hidden from other workers this long
+LEASE_SECONDS = 120
+
+QUEUED    = metrics.Counter("bridge_outbox_queued_total", "Deliveries handed to the outbox.", ("kind",))
+DELIVERED = metrics.Counter("bridge_outbox_delivered_total", "Outbox deliveries that succeeded on a retry.", ("kind",))
+GAVE_UP   = metrics.Counter("bridge_outbox_gave_up_total", "Outbox deliveries dropped after OUTBOX_MAX_AGE.", ("kind",))
+
+
+class Breaker:
+    """
+    Consecutive-failure circuit breaker. Open for `cooldown` seconds after
+    `threshold` failures in a row, then lets one attempt through (half open).
+    """
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.failures < self.threshold:
+                return True
+            if time.time() >= self.open_until:
+                # half open: one trial, the next failure re-opens
+                self.open_until = time.time() + self.cooldown
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.open_until = time.time() + self.cooldown
+
+    def is_open(self) -> bool:
+        return self.failures >= self.threshold and time.time() < self.open_until
+
+
+class Outbox:
+    def __init__(self):
+        self._kinds = {}      # kind -> (upstream, send, give_up)
+        self._breakers = {}   # upstream -> Breaker
+        self._ordered = {}    # order key -> deliveries queued in this process
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def register(self, kind: str, upstream: str, send, give_up=None):
+        """
+        `send(**args)` returns True when delivered (or not worth retrying),
+        False or raises to retry, and None to retry later without counting
+        against the upstream's breaker (it isn't ready to be sent yet).
+        `give_up(**args)` runs when a delivery is dropped after OUTBOX_MAX_AGE.
+        """
+        self._kinds[kind] = (upstream, send, give_up)
+        self._breakers.setdefault(upstream, Breaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN))
+
+    def _attempt(self, kind: str, args: dict) -> tuple[bool, str]:
+        upstream, send, _ = self._kinds[kind]
+        breaker = self._breakers[upstream]
+        if not breaker.allow():
+            return False, f"{upstream} circuit open"
+        try:
+            ok = send(**args)
+            error = "" if ok else "not ready" if ok is None else "delivery failed"
+        except Exception as e:
+            ok, error = False, repr(e)
+        if ok:
+            breaker.success()
+        elif ok is not None:
+            breaker.failure()
+        return bool(ok), error
+
+    def deliver(self, kind: str, args: dict, order: str | None = None, key: str | None = None) -> bool:
+        """
+        Deliver now, or queue for retry on failure. True if delivered now.
+        """
+        with self._lock:
+            behind = order is not None and self._ordered.get(order, 0) > 0
+        if behind:
+            self.enqueue(kind, args, order, key, "queued behind an earlier delivery")
+            return False
+        ok, error = self._attempt(kind, args)
+        if not ok:
+            self.enqueue(kind, args, order, key, error)
+        return ok
+
+    def enqueue(self, kind: str, args: dict, order: str | None = None, key: str | None = None, error: str = ""):
+        now = time.time()
+        key = key or f"{now:017.6f}-{uuid.uuid4().hex[:8]}"
+        with db.transaction():
+            existing = db.get_outbox(key)
+            if existing:
+                # same delivery queued again: newer args, keep its schedule
+                entry = dict(existing, args=args, last_error=error or existing["last_error"])
+            else:
+                entry = {"kind": kind, "args": args, "order": order, "created": now,
+                         "attempts": 0, "next_at": now + self._delay(0), "last_error": error}
+            db.put_outbox(key, entry)
+        if not existing:
+            with self._lock:
+                if order is not None:
+                    self._ordered[order] = self._ordered.get(order, 0) + 1
+            QUEUED.inc(kind)
+            print(f"Queued {kind} for retry ({error})")
+
+    def _delay(self, attempts: int) -> float:
+        # full jitter: uniform between half and all of the exponential step
+        step = min(OUTBOX_MAX_DELAY, OUTBOX_BASE_DELAY * 2 ** attempts)
+        return random.uniform(step / 2, step)
+
+    def _done(self, key: str, entry: dict):
+        db.pop_outbox(key)
+        order = entry.get("order")
+        if order is not None:
+            with self._lock:
+                left = self._ordered.get(order, 0) - 1
+                if left > 0:
+                    self._ordered[order] = left
+                else:
+                    self._ordered.pop(order, None)
+
+    def drain(self, limit: int = 100) -> int:
+        """
+        Retry due deliveries, oldest first. Returns how many got through.
+        """
+        now = time.time()
+        delivered = 0
+        # only the head of each order key is claimed; the next one becomes
+        # head (and is claimed on the next drain) once it is done
+        for key, entry in db.claim_due_outbox(now, LEASE_SECONDS, limit):
+            kind = entry["kind"]
+            if kind not in self._kinds:
+                continue
+            if now - entry["created"] > OUTBOX_MAX_AGE:
+                print(f"Giving up on {kind} {entry['args']} after {entry['attempts']} attempts: {entry['last_error']}")
+                give_up = self._kinds[kind][2]
+                if give_up:
+                    give_up(**entry["args"])
+                self._done(key, entry)
+                GAVE_UP.inc(kind)
+            else:
+                ok, error = self._attempt(kind, entry["args"])
+                if not ok:
+                    attempts = entry["attempts"] + 1
+                    next_at = time.time() + self._delay(attempts)
+                    db.put_outbox(key, dict(entry, attempts=attempts, next_at=next_at, last_error=error))
+                    continue
+                self._done(key, entry)
+                DELIVERED.inc(kind)
+                delivered += 1
+        return delivered
+
+    def _rebuild_order(self):
+        counts = {}
+        for entry in db.outbox().values():
+            if entry.get("order") is not None:
+                counts[entry["order"]] = counts.get(entry["order"], 0) + 1
+        with self._lock:
+            self._ordered = counts
+
+    def start(self):
+        if self._thread:
+            return
+        self._rebuild_order()
+
+        def loop():
+            while not self._stop.is_set():
+                try:
+                    self.drain()
+                    due = db.next_outbox_at()
+                except Exception as e:
+                    print("Outbox drain error:", e)
+                    due = None
+                wait = OUTBOX_POLL_SECONDS if due is None else min(OUTBOX_POLL_SECONDS, max(due - time.time(), 0.05))
+                self._stop.wait(wait)
+
+        self._thread = threading.Thread(target=loop, name="outbox", daemon=True)
+        self._thread.start()
+        print(f"Outbox worker started (poll={OUTBOX_POLL_SECONDS}s)")
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            ordered = dict(self._ordered)
+        return {
+            "pending": len(db.outbox()),
+            "ordered_keys": len(ordered),
+            "breakers": {name: {"open": b.is_open(), "failures": b.failures}
+                         for name, b in self._breakers.items()},
+        }
@@ -0,0 +1,250 @@
+"""
+Transcript records and the HTML renderer for RT comments.
+
+A transcript line is a `Line` record (direction, timestamp, body and an
+optional media uri / mime type), stored as a JSON list `[direction, ts, body,
+uri, mime]`. In memory a ticket's lines live in a `Lines` column store: a
+flags byte, a timestamp and a single string per line instead of a tuple or
+object per line.
+
+The renderer glues precomputed template pieces around each record, so a long
+transcript costs one html.escape and a couple of string joins per line.
+`render_iter` yields the document in chunks for callers that want to stream it.
+"""
+import html, re, time
+from array import array
+from enum import IntEnum
+from typing import NamedTuple
+from urllib.parse import urljoin, urlsplit
+
+
+class Direction(IntEnum):
+    NOTE = 0
+    TO_ENGINEER = 1
+    TO_CUSTOMER = 2
+
+NOTE, TO_ENGINEER, TO_CUSTOMER = Direction.NOTE, Direction.TO_ENGINEER, Direction.TO_CUSTOMER
+
+# Lines flag bits
+_DIRECTION, _HAS_URI, _HAS_MIME = 0b11, 0b100, 0b1000
+
+
+class Line(NamedTuple):
+    direction: int
+    ts: float           # 0 when unknown (lines from before timestamps were kept)
+    body: str
+    uri: str | None = None
+    mime: str | None = None
+
+    @classmethod
+    def load(cls, raw) -> "Line":
+        """
+        A record from its JSON list, or from an old free-form string line.
+        """
+        if isinstance(raw, Line):
+            return raw
+        if isinstance(raw, str):
+            return cls(*classify(raw))
+        return cls(Direction(raw[0]), *raw[1:])
+
+
+class Lines:
+    """
+    Column store for one ticket's lines; appends and slicing take and give
+    `Line` records (or anything Line.load accepts).
+
+    Per line there is one flags byte (direction, has uri, has mime), one
+    double for the timestamp and one string: the body, with the uri and mime
+    type (if any) tacked on after NUL separators.
+    """
+    __slots__ = ("_flags", "_ts", "_text")
+
+    def __init__(self, items=()):
+        self._flags = array("B")
+        self._ts = array("d")
+        self._text = []
+        self.extend(items)
+
+    def append(self, item):
+        direction, ts, body, uri, mime = Line.load(item)
+        flags, text = int(direction), body
+        if uri is not None:
+            flags, text = flags | _HAS_URI, text + "\0" + uri.replace("\0", "")
+        if mime is not None:
+            flags, text = flags | _HAS_MIME, text + "\0" + mime.replace("\0", "")
+        self._flags.append(flags)
+        self._ts.append(ts)
+        self._text.append(text)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def __len__(self) -> int:
+        return len(self._text)
+
+    def copy(self) -> "Lines":
+        out = Lines()
+        out._flags, out._ts, out._text = self._flags[:], self._ts[:], self._text[:]
+        return out
+
+    def _line(self, i: int) -> Line:
+        flags, text = self._flags[i], self._text[i]
+        uri = mime = None
+        if flags & _HAS_MIME:
+            text, mime = text.rsplit("\0", 1)
+        if flags & _HAS_URI:
+            text, uri = text.rsplit("\0", 1)
+        return Line(Direction(flags & _DIRECTION), self._ts[i], text, uri, mime)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._line(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._line(index)
+
+    def __iter__(self):
+        return (self._line(i) for i in range(len(self)))
+
+    def __repr__(self) -> str:
+        return f"Lines({list(self)!r})"
+
+# old string lines ("Customer to ENG: ...", "ENG sent file: ...") are only
+# parsed when they are migrated to records, never when rendering
+_LINE_RE = re.compile(
+    r"^(?:"
+    r"(?P<dir>Customer to ENG|ENG to Customer):\s*(?P<text>.*)"
+    r"|Customer sent (?:image|file):\s*(?P<ctext>.*?)(?:\s*<(?P<curl>.+?)>)?\s*"
+    r"|ENG sent file:\s*(?P<etext>.*?)(?:\s*\(as (?P<emime>[^)]+)\))?(?:\s*<(?P<eurl>.+?)>)?\s*"
+    r")$",
+    re.I,
+)
+_URL_RE    = re.compile(r'(https?://[^\s<]+)')
+_UPLOAD_RE = re.compile(r'(/user_uploads/[^\s<]+)')
+
+def _pill(bg: str, fg: str, label: str) -> str:
+    return (
+        "\n        <div style=\"border:1px solid #e5e7eb;border-radius:12px;padding:12px 14px;margin:10px 0;background:#ffffff;\">"
+        "\n          <div style=\"display:flex;align-items:center;justify-content:space-between;margin-bottom:6px;\">"
+        f"\n            <span style=\"display:inline-block;padding:3px 10px;border-radius:999px;background:{bg};color:{fg};font-size:12px;font-weight:600;\">"
+        f"\n              {html.escape(label)}"
+        "\n            </span>"
+        "\n            <span style=\"font-size:12px;color:#6b7280;\">#"
+    )
+
+# card template, split around the line number and the message body
+_CARD_HEAD = {
+    NOTE:        _pill("#e5e7eb", "#111827", "Note"),
+    TO_ENGINEER: _pill("#dbeafe", "#1e3a8a", "Customer → Engineer"),
+    TO_CUSTOMER: _pill("#dcfce7", "#14532d", "Engineer → Customer"),
+}
+_CARD_MID = (
+    "</span>"
+    "\n          </div>"
+    "\n          <div style=\"font-size:14px;color:#111827;line-height:1.5;\">"
+)
+_CARD_TAIL = "</div>\n        </div>\n        "
+
+_DOC_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+  <meta charset="utf-8">
+  <title>Transcript #{ticket_id}</title>
+</head>
+<body style="background:#f9fafb;margin:0;padding:0;font-family:ui-sans-serif,system-ui,-apple-system,Segoe UI,Roboto,Ubuntu,Cantarell,Noto Sans,sans-serif;">
+  <div style="max-width:820px;margin:24px auto;padding:0 16px;">
+    <div style="margin-bottom:14px;">
+      <h2 style="margin:0 0 6px 0;font-size:20px;color:#111827;">WhatsApp ↔ Zulip Transcript</h2>
+      <div style="font-size:13px;color:#6b7280;">Ticket #{ticket_id}</div>
+    </div>
+    """
+_DOC_TAIL = """
+  </div>
+</body>
+</html>"""
+
+
+def classify(raw: str) -> tuple[int, float, str, str | None, str | None]:
+    """
+    Split an old string line into Line fields (direction, ts, content, media
+    link, mime type). Old lines carry no timestamp, so ts is 0.
+    """
+    m = _LINE_RE.match(raw)
+    if m is None:
+        return NOTE, 0.0, raw, None, None
+    d = m.group("dir")
+    if d is not None:
+        return (TO_ENGINEER if d[0] in "cC" else TO_CUSTOMER), 0.0, m.group("text"), None, None
+    if m.group("ctext") is not None:
+        return TO_ENGINEER, 0.0, m.group("ctext"), m.group("curl"), None
+    return TO_CUSTOMER, 0.0, m.group("etext"), m.group("eurl"), m.group("emime")
+
+
+_ORIGINS = {}
+
+def _absolute(base_url: str, path: str) -> str:
+    """
+    urljoin(base_url, path) for a root-relative path. The common case (no dot
+    segments, no whitespace) is just origin + path, skipping urljoin's parsing.
+    """
+    if path.startswith("/") and not path.startswith("//") and "/." not in path and not any(c.isspace() for c in path):
+        origin = _ORIGINS.get(base_url)
+        if origin is None:
+            parts = urlsplit(base_url)
+            origin = _ORIGINS[base_url] = f"{parts.scheme}://{parts.netloc}" if parts.netloc else None
+        if origin:
+            return origin + path
+    return urljoin(base_url, path)
+
+
+def _linkify(s: str, base_url: str) -> str:
+    if "http" in s:
+        s = _URL_RE.sub(
+            lambda m: f'<a href="{html.escape(m.group(0))}" target="_blank" rel="noopener">{html.escape(m.group(0))}</a>',
+            s,
+        )
+    if "/user_uploads/" in s:
+        s = _UPLOAD_RE.sub(
+            lambda m: f'<a href="{html.escape(_absolute(base_url, m.group(1)))}" target="_blank" rel="noopener">Download</a>',
+            s,
+        )
+    return s
+
+
+def _stamp(ts: float) -> str:
+    return time.strftime(" · %Y-%m-%d %H:%M UTC", time.gmtime(ts)) if ts else ""
+
+
+def render_card(i: int, line: Line, base_url: str) -> str:
+    direction, ts, content, link_url, _ = line
+    safe = html.escape(content).replace("\n", "<br>")
+    if link_url:
+        if link_url.startswith("/"):
+            link_url = _absolute(base_url, link_url)
+        safe += f'<br><a href="{html.escape(link_url)}" target="_blank" rel="noopener">Link to Media</a>'
+    else:
+        safe = _linkify(safe, base_url)
+    return _CARD_HEAD[direction] + str(i) + _stamp(ts) + _CARD_MID + safe + _CARD_TAIL
+
+
+def render_iter(ticket_id, lines, base_url: str, first_index: int = 1, chunk_cards: int = 256):
+    """
+    Yield the HTML document in pieces of about `chunk_cards` cards.
+    """
+    yield _DOC_HEAD.format(ticket_id=ticket_id)
+    buf = []
+    for i, line in enumerate(lines, first_index):
+        buf.append(render_card(i, line, base_url))
+        if len(buf) >= chunk_cards:
+            yield "".join(buf)
+            buf = []
+    if buf:
+        yield "".join(buf)
+    yield _DOC_TAIL
+
+
+def render(ticket_id, lines, base_url: str, first_index: int = 1) -> str:
+    return "".join(render_iter(ticket_id, lines, base_url, first_index))
@@ -0,0 +1,83 @@
+"""
+Shared HTTP clients for the three upstreams (Graph API, Zulip, RT).
+
+One keep-alive `requests.Session` per upstream so repeated calls reuse
+pooled TCP/TLS connections instead of a fresh handshake each time. Auth and
+a default timeout are baked in; callers can still override per call.
+"""
+import os, threading, time
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+
+
+class UpstreamBusy(requests.exceptions.RequestException):
+    """
+    No concurrency slot for this upstream became free within `slot_wait`.
+    """
+
+
+class Upstream:
+    def __init__(self, name: str, timeout: float, auth=None, headers: dict | None = None,
+                 pool_size: int = HTTP_POOL_SIZE, max_concurrency: int | None = None,
+                 slot_wait: float | None = None):
+        self.name = name
+        self.timeout = timeout
+        # caps in-flight calls to this upstream across all threads; a call
+        # that can't get a slot within `slot_wait` (default: the timeout)
+        # fails with UpstreamBusy instead of queueing behind a slow upstream
+        self._slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self.slot_wait = timeout if slot_wait is None else slot_wait
+        self.inflight = 0
+        self._inflight_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        if auth:
+            self.session.auth = auth
+        if headers:
+            self.session.headers.update(headers)
+
+    def request(self, method: str, url: str, op: str | None = None, **kwargs) -> requests.Response:
+        """
+        `op` names the call type (e.g. "rt_create") in the latency and error
+        metrics; it defaults to the HTTP method.
+        """
+        op = op or method.lower()
+        kwargs.setdefault("timeout", self.timeout)
+        started = time.perf_counter()
+        try:
+            resp = self._send(method, url, **kwargs)
+        except Exception as e:
+            metrics.UPSTREAM_ERRORS.inc(self.name, op, type(e).__name__)
+            raise
+        finally:
+            metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - started, self.name, op)
+        if resp.status_code >= 400:
+            metrics.UPSTREAM_ERRORS.inc(self.name, op, f"http_{resp.status_code // 100}xx")
+        return resp
+
+    def _send(self, method: str, url: str, **kwargs) -> requests.Response:
+        if self._slots is not None and not self._slots.acquire(timeout=self.slot_wait):
+            raise UpstreamBusy(f"{self.name}: all concurrency slots busy")
+        with self._inflight_lock:
+            self.inflight += 1
+        try:
+            return self.session.request(method, url, **kwargs)
+        finally:
+            with self._inflight_lock:
+                self.inflight -= 1
+            if self._slots is not None:
+                self._slots.release()
+
+    def get(self, url: str, op: str | None = None, **kwargs) -> requests.Response:
+        return self.request("GET", url, op, **kwargs)
+
+    def post(self, url: str, op: str | None = None, **kwargs) -> requests.Response:
+        return self.request("POST", url, op, **kwargs)
+
+    def close(self):
+        self.session.close()